@@ -1,20 +1,190 @@
 #!/usr/bin/env python3
-# WIP. Searching bb files for certain parameters...
+# Searching bb files for certain parameters.
+#
+# Usage: ./bbgrep.py [-i INDEX | -I] TERM FILE|DIR ...
+#        ./bbgrep.py [-i INDEX | -I] -e TERM [-e TERM ...] FILE|DIR ...
+# A TERM is either the name of a param, matching the files that have it, or a
+# predicate on one like kyoom=true or maxflux>5 or yoog~^alice/ (with = != <
+# <= > >= and ~ for a regex search). The value is parsed as JSON if it can be
+# and is taken as a string otherwise. Prints each file matching all the terms
+# with the value of each of those params, like
+#   data/foo.bb: kyoom=True maxflux=10
+# Directories are searched (recursively) for .bb files.
+#
+# The params of every file we look at are kept in an index, a SQLite database
+# (~/.bbgrep.sqlite unless you say otherwise with -i), keyed by path and noting
+# each file's mtime and size. So only files that changed since last time get
+# parsed again and the rest is SQLite checking the params against the terms.
+# Files that have since disappeared stay in the index but are harmless since we
+# only ever look up the files we were asked about. With -I it doesn't keep an
+# index and just parses everything.
+#
+# Parsing a file only goes as far as the end of the params, which normally come
+# before the data, so mostly we don't even read the data. Files with the data
+# first get parsed in full. The parsing is farmed out to a pool of processes
+# (-j, default one per CPU) and the matches are printed as they come, in order.
 
-import sys, os, json
+import sys, os, re, json, getopt, signal, sqlite3
+import multiprocessing as mp
+
+INDEX = os.path.expanduser("~/.bbgrep.sqlite")
+CHUNK = 1 << 14 # read this many characters at a time looking for the params
+HEAD = re.compile(r'\s*\{\s*"params"\s*:\s*') # a bb file with the params first
+BATCH = 1000 # write this many newly parsed files to the index at a time
+TERM = re.compile(r"^\s*([^=!<>~\s]+)\s*(!=|<=|>=|=|<|>|~)\s*(.*)$")
+
+def usage():
+  print("Usage: bbgrep.py [-i INDEX | -I] TERM FILE|DIR ...")
+  print("       bbgrep.py [-i INDEX | -I] -e TERM [-e TERM ...] FILE|DIR ...")
+  print("Prints the bb files that have all the given params (or satisfy all")
+  print("predicates on them, like kyoom=true or maxflux>5) and their values.")
+  print("  -i INDEX: keep the index of params in INDEX (default", INDEX + ")")
+  print("  -I:       don't keep an index; parse every file")
+  print("  -j N:     parse files in N processes (default one per CPU)")
+  sys.exit(1)
+
+# A term as (param name, operator, value), the operator and value being None
+# for a bare param name
+def parseterm(s):
+  m = TERM.match(s)
+  if m is None: return (s.strip(), None, None)
+  (k, op, v) = m.groups()
+  if op == "~": return (k, op, v)
+  try:               v = json.loads(v)
+  except ValueError: pass
+  return (k, op, v)
+
+# The .bb files among the paths given, with directories searched recursively
+def bbfiles(paths):
+  for p in paths:
+    if not os.path.isdir(p):
+      if os.path.splitext(p)[1] == ".bb": yield p
+      continue
+    for (d, subs, fs) in os.walk(p):
+      subs.sort()
+      for f in sorted(fs):
+        if os.path.splitext(f)[1] == ".bb": yield os.path.join(d, f)
+
+# The params of a bb file, parsing only as much of it as it takes
+def scanparams(myfile):
+  dec = json.JSONDecoder()
+  raw = myfile.read(CHUNK)
+  m = HEAD.match(raw)
+  while m:
+    try:
+      (params, end) = dec.raw_decode(raw, m.end())
+      if isinstance(params, dict): return params
+      break
+    except ValueError: pass
+    more = myfile.read(len(raw)) # not there yet; read as much again
+    if not more: break
+    raw += more
+  return json.loads(raw + myfile.read())["params"]
+
+# The params of a bb file as JSON, or None if it isn't one
+def readparams(f):
+  try:
+    with open(f, "r", encoding="utf-8") as myfile: params = scanparams(myfile)
+    if not isinstance(params, dict): raise TypeError("params not a dict")
+    return json.dumps(params, ensure_ascii=False, separators=(",", ":"))
+  except (ValueError, KeyError, TypeError, UnicodeError) as e:
+    print(f"Error! Couldn't parse {f}: {e}", file=sys.stderr)
+    return None
+  except OSError as e:
+    print(f"Error: {e}", file=sys.stderr)
+    return None
+
+def opendb(ixfile):
+  db = sqlite3.connect(ixfile, timeout=60)
+  db.execute("""CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY,
+                mtime INTEGER, size INTEGER, params TEXT)""")
+  db.create_function("research", 2, lambda pat, x: x is not None and
+                     re.search(pat, str(x)) is not None, deterministic=True)
+  return db
+
+# SQL for a term, and the arguments to go with it
+def where(term):
+  (k, op, v) = term
+  jp = '$."' + k.replace('"', '\\"') + '"'
+  if op is None: return ("json_type(params, ?) IS NOT NULL", [jp])
+  if op == "~":  return ("research(?, json_extract(params, ?))", [v, jp])
+  if isinstance(v, (list, dict)):
+    v = json.dumps(v, ensure_ascii=False, separators=(",", ":"))
+  if v is None:
+    return ("json_type(params, ?) " + ("=" if op == "=" else "!=") + " 'null'",
+            [jp])
+  return ("json_extract(params, ?) " + op + " ?", [jp, v])
+
+# The params (as JSON) of each of the given files (as absolute paths), in order,
+# or None for the ones that aren't bb files: straight from the index for the
+# ones whose mtime and size are as indexed, else parsed anew, by a pool of nproc
+# processes if there's more than one, and stored in the index
+def params(db, paths, nproc):
+  known = dict(((p, (m, s, x)) for (p, m, s, x) in
+                db.execute("SELECT path, mtime, size, params FROM want JOIN "
+                           "files USING (path)")))
+  stats = []
+  for p in paths:
+    try: st = os.stat(p)
+    except OSError as e: print(f"Error: {e}", file=sys.stderr); st = None
+    stats.append((st.st_mtime_ns, st.st_size) if st else None)
+  stale = [p for (p, ms) in zip(paths, stats)
+           if ms and known.get(p, (None,)*3)[:2] != ms]
+  pool = mp.Pool(nproc) if nproc > 1 and len(stale) > 1 else None
+  parsed = pool.imap(readparams, stale, 16) if pool else map(readparams, stale)
+  new = []
+  try:
+    for (p, ms) in zip(paths, stats):
+      if ms is None: yield None; continue
+      if known.get(p, (None,)*3)[:2] == ms: yield known[p][2]; continue
+      x = next(parsed)
+      new.append((p, ms[0], ms[1], x))
+      if len(new) >= BATCH: store(db, new)
+      yield x
+  finally:
+    store(db, new) # even if we're cut short, keep what we did parse
+    if pool: pool.terminate()
+
+# Write newly parsed files to the index
+def store(db, new):
+  with db: db.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?,?)", new)
+  new[:] = []
 
 def main(argv):
-  bbparam = argv[0]
-
-  for f in argv[1:]:
-    base = os.path.basename(f)
-    ext = os.path.splitext(base)[1]
-    if (ext != ".bb"): continue 
-    with open(f, 'r') as myfile: 
-      bb = json.loads(myfile.read())
-      params = bb["params"]
-      if (bbparam in params) :
-        print(base+": "+bbparam+"="+str(params[bbparam]))
+  try: opts, args = getopt.getopt(argv, "hi:Ie:j:")
+  except getopt.GetoptError: usage()
+  ixfile = INDEX
+  terms = []
+  nproc = os.cpu_count()
+  for opt, arg in opts:
+    if   opt == "-h": usage()
+    elif opt == "-i": ixfile = arg
+    elif opt == "-I": ixfile = ":memory:"
+    elif opt == "-e": terms.append(arg)
+    elif opt == "-j": nproc = int(arg)
+  if not terms and args: terms.append(args.pop(0))
+  if not terms: usage()
+  terms = [parseterm(t) for t in terms]
+  names = list(dict.fromkeys(k for (k,_,_) in terms))
+
+  files = list(bbfiles(args))
+  paths = [os.path.abspath(f) for f in files]
+  db = opendb(ixfile)
+  db.execute("CREATE TEMP TABLE want (path TEXT)")
+  db.executemany("INSERT INTO want VALUES (?)", ((p,) for p in paths))
+
+  # Each file's params get checked against the terms by SQLite as they come, so
+  # the matches can be printed as we go
+  conds = [where(t) for t in terms]
+  q = ("SELECT 1 FROM (SELECT ? AS params) WHERE params IS NOT NULL" +
+       "".join(" AND " + c for (c, _) in conds))
+  qargs = [x for (_, xs) in conds for x in xs]
+  signal.signal(signal.SIGPIPE, signal.SIG_DFL) # just die if piped to head
+  for (f, x) in zip(files, params(db, paths, nproc)):
+    if x is None or db.execute(q, [x] + qargs).fetchone() is None: continue
+    x = json.loads(x)
+    print(f + ": " + " ".join(k + "=" + str(x[k]) for k in names if k in x),
+          flush=True)
 
 # Make sure we only execute main in the top-level environment or something
 if __name__ == "__main__":
@@ -2,9 +2,17 @@
 # Reformat a bb file to be more human-parsable but still compact.
 # Usage: ./jsunnier.py input.bb
 # Modifies the file in place and creates a backup at input.bb.bak
+# Batch mode: ./jsunnier.py [-j N] FILE|DIR|GLOB ...
+# does that to every .bb file given, in the directories given, or matching the
+# (quoted) globs given, N files at a time (default one per CPU), and reports the
+# throughput at the end. Each formatted file is written to a temp file that then
+# replaces the original with an atomic rename, so nothing ever sees it half
+# written. Files that come out the same as they went in (the formatted version
+# hashes the same) are already canonical and are left alone, no backup either.
 # HT GPT-5 and Claude Code
 
-import sys, json, shutil
+import sys, os, json, glob, getopt, shutil, hashlib, tempfile, time
+import multiprocessing as mp
 
 ORDER = [
 "yoog","gunits","yaxis",
@@ -37,84 +45,140 @@ def dumpit(x):
   return json.dumps(x, ensure_ascii=False, separators=(",", ":"))
 
 def usage():
-  print("Usage: jsunnier.py FILE")
+  print("Usage: jsunnier.py [-j N] FILE|DIR|GLOB ...")
   print("Reformats a bb JSON file to be more human-parsable but still compact.")
   print("Modifies FILE in place and creates a backup at FILE.bak")
+  print("Given directories or globs, does that to all the .bb files in them,")
+  print("N at a time (default one per CPU), skipping ones already formatted.")
   sys.exit(1)
 
-if len(sys.argv) != 2: usage()
-filename = sys.argv[1]
-try:
-  with open(filename, "r", encoding="utf-8") as f: raw = f.read().strip()
-except FileNotFoundError:
-  print(f"Error: File '{filename}' not found", file=sys.stderr)
-  sys.exit(1)
-except Exception as e:
-  print(f"Error reading file: {e}", file=sys.stderr)
-  sys.exit(1)
-
-try:
-  obj = json.loads(raw) # parse the JSON or die trying
-except json.JSONDecodeError as e:
-  print(f"Error! File is not valid JSON: {e}", file=sys.stderr)
-  sys.exit(1)
-
-# If the JSON doesn't have the expected structure, leave it alone and abort
-if (not isinstance(obj, dict) or 
-    "params" not in obj or 
-    "data"   not in obj or
-    not isinstance(obj["params"], dict) or 
-    not isinstance(obj["data"], list)):
-  print(f"Error! Not a bb file? Expected 'params' dict, 'data' list. Aborting.",
-        file=sys.stderr)
-  sys.exit(0)
-
-params = obj["params"]
-data   = obj["data"]
-
-## Any temporary data conversion can go here...
-if params.get("odom"): # Add @TARE to comments of zero-value datapoints
-  for row in data:
-    if len(row) >= 2 and (row[1] == 0 or row[1] == 0.0):
-      if len(row) < 3: row.append("@TARE")    # in case comment field is missing
-      elif "@TARE" not in row[2]: row[2] = row[2] + " @TARE"
-## End temporary data conversion.
-
-# Build ordered list of param keys: specified ORDER first, then any extras in
-# their original order.
-extras = [k for k in params.keys() if k not in ORDER]
-keys   = [k for k in ORDER         if k     in params] + extras
-
-out = []
-out.append('{"params":{')
-
-# Emit params (special-case "road" to keep each waypoint on a single line)
-for i, k in enumerate(keys):
-  v = params[k]
-  if k == "road" and isinstance(v, list):
-    out.append(f'"{k}":[')
-    out.extend(dumpit(x) + ("," if j<len(v)-1 else "") for j, x in enumerate(v))
-    out.append("]" + ("," if i < len(keys)-1 else ""))
-  else:
-    out.append(f'"{k}":{dumpit(v)}' + ("," if i < len(keys)-1 else ""))
-
-out.append("},")
-out.append('"data":[')
-
-# Each datapoint on its own line, inner array on one line
-for i, row in enumerate(data):
-  out.append(dumpit(row) + ("," if i < len(data)-1 else ""))
-
-out.append("]}\n")
-formatted = "\n".join(out)
-
-backup_filename = filename + ".bak"      # safety net just in case we mess it up
-shutil.copy2(filename, backup_filename)
-
-# Write the formatted output back to the original file
-try:
-  with open(filename, "w", encoding="utf-8") as f: f.write(formatted)
-  print(f"Formatted {filename} (backup saved to {backup_filename})")
-except Exception as e:
-  print(f"Error writing file: {e}", file=sys.stderr)
-  sys.exit(1)
+# The .bb files among the args, with directories and globs expanded
+def bbfiles(args):
+  for a in args:
+    if os.path.isdir(a): yield from sorted(glob.glob(os.path.join(a, "*.bb")))
+    elif glob.has_magic(a): yield from sorted(glob.glob(a))
+    else: yield a
+
+# The lines of the formatted bb file, given the parsed JSON
+def formatted(obj):
+  params = obj["params"]
+  data   = obj["data"]
+
+  ## Any temporary data conversion can go here...
+  if params.get("odom"): # Add @TARE to comments of zero-value datapoints
+    for row in data:
+      if len(row) >= 2 and (row[1] == 0 or row[1] == 0.0):
+        if len(row) < 3: row.append("@TARE")  # in case comment field is missing
+        elif "@TARE" not in row[2]: row[2] = row[2] + " @TARE"
+  ## End temporary data conversion.
+
+  # Build ordered list of param keys: specified ORDER first, then any extras in
+  # their original order.
+  extras = [k for k in params.keys() if k not in ORDER]
+  keys   = [k for k in ORDER         if k     in params] + extras
+
+  yield '{"params":{'
+
+  # Emit params (special-case "road" to keep each waypoint on a single line)
+  for i, k in enumerate(keys):
+    v = params[k]
+    if k == "road" and isinstance(v, list):
+      yield f'"{k}":['
+      yield from (dumpit(x) + ("," if j<len(v)-1 else "")
+                  for j, x in enumerate(v))
+      yield "]" + ("," if i < len(keys)-1 else "")
+    else:
+      yield f'"{k}":{dumpit(v)}' + ("," if i < len(keys)-1 else "")
+
+  yield "},"
+  yield '"data":['
+
+  # Each datapoint on its own line, inner array on one line
+  for i, row in enumerate(data):
+    yield dumpit(row) + ("," if i < len(data)-1 else "")
+
+  yield "]}"
+
+# Reformat one bb file. Returns (what happened, message, bytes read) where what
+# happened is "formatted", "canonical", "skipped" (not a bb file) or "error".
+def jsunnify(filename):
+  try:
+    with open(filename, "rb") as f: raw = f.read()
+    obj = json.loads(raw.decode("utf-8").strip()) # parse the JSON or die trying
+  except FileNotFoundError:
+    return ("error", f"Error: File '{filename}' not found", 0)
+  except ValueError as e: # including json.JSONDecodeError and UnicodeError
+    return ("error", f"Error! File {filename} is not valid JSON: {e}", 0)
+  except Exception as e:
+    return ("error", f"Error reading file {filename}: {e}", 0)
+
+  # If the JSON doesn't have the expected structure, leave it alone and abort
+  if (not isinstance(obj, dict) or
+      "params" not in obj or
+      "data"   not in obj or
+      not isinstance(obj["params"], dict) or
+      not isinstance(obj["data"], list)):
+    return ("skipped", f"Error! {filename}: Not a bb file? Expected 'params' " +
+                       "dict, 'data' list. Aborting.", len(raw))
+
+  # Stream the formatted file to a temp file in the same directory, hashing it
+  # as we go to see if it's any different from the original
+  h = hashlib.sha1()
+  (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+                               prefix=os.path.basename(filename) + ".",
+                               suffix=".tmp")
+  try:
+    with open(fd, "w", encoding="utf-8") as f:
+      for i, line in enumerate(formatted(obj)):
+        s = ("\n" if i > 0 else "") + line
+        h.update(s.encode("utf-8"))
+        f.write(s)
+      h.update(b"\n")
+      f.write("\n")
+    if h.digest() == hashlib.sha1(raw).digest():
+      os.remove(tmp)
+      return ("canonical", f"Already formatted {filename}", len(raw))
+    shutil.copymode(filename, tmp)
+    backup_filename = filename + ".bak"  # safety net just in case we mess it up
+    shutil.copy2(filename, backup_filename)
+    os.rename(tmp, filename)
+  except Exception as e:
+    if os.path.exists(tmp): os.remove(tmp)
+    return ("error", f"Error writing file {filename}: {e}", len(raw))
+  return ("formatted",
+          f"Formatted {filename} (backup saved to {backup_filename})", len(raw))
+
+def main(argv):
+  try: opts, args = getopt.getopt(argv, "hj:")
+  except getopt.GetoptError: usage()
+  nproc = os.cpu_count()
+  for opt, arg in opts:
+    if   opt == "-h": usage()
+    elif opt == "-j": nproc = int(arg)
+  if len(args) < 1: usage()
+
+  files = list(bbfiles(args))
+  batch = len(files) != 1 or files[0] not in args # more than the one file
+  start = time.time()
+  tally = dict.fromkeys(["formatted", "canonical", "skipped", "error"], 0)
+  nbytes = 0
+  pool = mp.Pool(nproc) if nproc > 1 and len(files) > 1 else None
+  try:
+    results = pool.imap(jsunnify, files) if pool else map(jsunnify, files)
+    for (what, msg, n) in results:
+      tally[what] += 1
+      nbytes += n
+      if what in ["error", "skipped"]: print(msg, file=sys.stderr)
+      elif what == "formatted" or not batch: print(msg)
+  finally:
+    if pool: pool.close()
+  if batch:
+    secs = max(time.time() - start, 1e-6)
+    print(f"{len(files)} files ({tally['formatted']} formatted, " +
+          f"{tally['canonical']} already formatted, {tally['skipped']} not " +
+          f"bb files, {tally['error']} errors) in {secs:.2f}s: " +
+          f"{len(files)/secs:.0f} files/s, {nbytes/secs/1e6:.1f} MB/s")
+  if tally["error"]: sys.exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
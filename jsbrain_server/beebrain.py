@@ -1,29 +1,126 @@
 #!/usr/bin/env python3
 # Command-line interface to Beebrain.
-# Takes a bb file as the only argument and runs it through the Beebrain server
-# running locally (by default on port 8777). Puts the .png and .json and the 
-# thumbnail in the same directory as the bb file.
+# Takes bb files (or directories of them) as arguments and runs them through the
+# Beebrain server running locally (by default on port 8777). Puts the .png and
+# .json and the thumbnail in the same directory as each bb file.
+#
+# Up to N goals (-j N, default 4) are in flight at once, each over one of N
+# keep-alive connections to the server, so a directory full of goals keeps all
+# the server's workers busy. For each goal it prints how long the server took or
+# what went wrong, and with more than one goal a summary at the end. Given a
+# single goal it prints the server's whole response instead, like it always did,
+# and opens the graph (that's macOS's "open -g"; skipped when headless or with
+# -n).
 
-from sys import argv
-import os, re
-from urllib.parse import quote_plus
+import sys, os, re, json, glob, time, getopt, shutil, threading
+import http.client
+from urllib.parse import urlencode, urlsplit
+from concurrent.futures import ThreadPoolExecutor
 
 BBURL = "http://localhost:8777/"
 
-if len(argv) != 2: print(f"USAGE: {argv[0]} BBFILE"); exit(1)
-# (might be handy to do this for all bbfiles provided if more than one)
-bbf = argv[1]
-if not os.path.isfile(bbf): print('Not a beebrain file:',bbf); exit(1)
+def usage():
+  print(f"USAGE: {sys.argv[0]} [-j N] [-n] [-u URL] BBFILE|DIR ...")
+  print("  -j N:   send up to N goals to the server at once (default 4)")
+  print("  -n:     don't open the graph afterwards")
+  print(f"  -u URL: the Beebrain server (default {BBURL})")
+  exit(1)
 
-m = re.match(r"""(.*?)     # path: everything up to the last slash
-                 ([^\/]+)  # slug: everything between last slash and '.bb'
-                 \.bb$""", bbf, re.X)
-if m == None: print('ERROR:', bbf, 'not a bbfile!'); exit(1)
-path  = m.group(1)  # eg, "path/to/data/"
-slug  = m.group(2)  # eg, "alice+foo"
+# The bb files among the args, directories replaced by the bb files in them
+def bbfiles(args):
+  for a in args:
+    if os.path.isdir(a): yield from sorted(glob.glob(os.path.join(a, "*.bb")))
+    else: yield a
 
-#print(   f'curl "{BBURL}?slug={quote_plus(slug)}&inpath=`pwd`/{path}"')
-os.system(f'curl "{BBURL}?slug={quote_plus(slug)}&inpath=`pwd`/{path}"')
-print() # curl's output doesn't end in a newline so, you're welcome 
-os.system(f'open -g {path}{slug}.png') # this might only work on macs?
+# Whether there's anyone to look at a graph if we opened it
+def headless():
+  return (sys.platform != "darwin" or shutil.which("open") is None or
+          "SSH_CONNECTION" in os.environ)
 
+local = threading.local() # each thread's connection to the server
+
+# GET the url over this thread's keep-alive connection, reconnecting once if
+# the server closed it on us in the meantime. Returns (status, body).
+def get(url):
+  u = urlsplit(url)
+  for attempt in [0, 1]:
+    if getattr(local, "conn", None) is None:
+      local.conn = http.client.HTTPConnection(u.hostname, u.port or 80)
+    try:
+      local.conn.request("GET", (u.path or "/") + "?" + u.query)
+      resp = local.conn.getresponse()
+      return (resp.status, resp.read())
+    except (http.client.RemoteDisconnected, BrokenPipeError,
+            ConnectionResetError):
+      local.conn.close(); local.conn = None
+      if attempt: raise
+    except Exception:
+      local.conn.close(); local.conn = None
+      raise
+
+# Have the server brain the given bb file. Returns (seconds, response body or
+# None, error message or None).
+def brain(bburl, bbf):
+  starttm = time.time()
+  m = re.match(r"""(.*?)     # path: everything up to the last slash
+                   ([^\/]+)  # slug: everything between last slash and '.bb'
+                   \.bb$""", bbf, re.X)
+  if not os.path.isfile(bbf): return (0, None, 'Not a beebrain file: ' + bbf)
+  if m == None: return (0, None, 'ERROR: ' + bbf + ' not a bbfile!')
+  path  = m.group(1)  # eg, "path/to/data/"
+  slug  = m.group(2)  # eg, "alice+foo"
+  inpath = os.path.abspath(path or ".")
+  try:
+    (status, body) = get(bburl + "?" + urlencode({"slug": slug,
+                                                  "inpath": inpath}))
+  except (OSError, http.client.HTTPException) as e:
+    return (time.time() - starttm, None, f"Couldn't reach {bburl}: {e}")
+  body = body.decode("utf-8", "replace")
+  dt = time.time() - starttm
+  if status != 200: return (dt, body, f"HTTP {status}")
+  try:               err = json.loads(body).get("error")
+  except ValueError: err = "Unparseable response"
+  return (dt, body, err)
+
+def main(argv):
+  try: opts, args = getopt.getopt(argv, "hj:nu:")
+  except getopt.GetoptError: usage()
+  nconn = 4
+  show = True
+  bburl = BBURL
+  for opt, arg in opts:
+    if   opt == "-h": usage()
+    elif opt == "-j": nconn = max(1, int(arg))
+    elif opt == "-n": show = False
+    elif opt == "-u": bburl = arg
+  if len(args) < 1: usage()
+  bbfs = list(bbfiles(args))
+
+  if len(bbfs) == 1 and not os.path.isdir(args[0]):
+    (dt, body, err) = brain(bburl, bbfs[0])
+    if body is not None: print(body) # the response doesn't end in a newline
+    if err is not None: print(err); exit(1)
+    png = re.sub(r"\.bb$", ".png", bbfs[0])
+    if show and not headless(): os.system(f'open -g "{png}"')
+    return
+
+  starttm = time.time()
+  fails = []
+  times = []
+  with ThreadPoolExecutor(nconn) as pool:
+    results = pool.map(lambda f: brain(bburl, f), bbfs) # in order, as they come
+    for (bbf, (dt, body, err)) in zip(bbfs, results):
+      if err is None: print(f"{bbf}: {dt:.2f}s"); times.append(dt)
+      else: print(f"{bbf}: FAILED after {dt:.2f}s: {err}"); fails.append(bbf)
+      sys.stdout.flush()
+  wall = time.time() - starttm
+  print(f"{len(bbfs)} goals in {wall:.1f}s ({len(bbfs)/max(wall,1e-6):.2f}/s),",
+        f"{len(fails)} failed" + (":" if fails else ""), " ".join(fails))
+  if times:
+    times.sort()
+    print(f"latency: median {times[len(times)//2]:.2f}s,",
+          f"max {times[-1]:.2f}s")
+  if fails: exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
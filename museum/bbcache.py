@@ -0,0 +1,138 @@
+"""
+Content-addressed cache of Beebrain output, so re-rendering a goal whose inputs
+haven't changed costs a hash and a few hard links instead of a parse, a genStats
+and a genGraph.
+
+Usage:
+> k = fingerprint(bbfile, extra)  # hash of the input files, code version, extra
+> if fetch(cdir, k, outs): done   # outs maps names like 'png' to target files
+> ...otherwise generate the outs as usual, then...
+> store(cdir, k, outs)
+
+Fingerprints: fingerprint(bbfile, extra) hashes the goal's input files as they
+are on disk, plus the code version and extra, without parsing anything, which is
+what makes a hit cheap. Beebrain also keeps the fingerprint of what it last
+generated next to the outputs so it can skip goals whose inputs are
+byte-identical to last time.
+
+Each entry is a directory named by the key holding one file per output. Files
+are hard-linked (or copied, if that fails) into place via a temp file and an
+atomic rename, same as freshly generated output, so readers never see a partial
+file. That means the output files must never be written in place, only replaced
+by renaming a new file over them. An entry's mtime is bumped whenever it's hit
+so evicting the stalest entries till the cache fits in CACHEMAX bytes is LRU.
+That means looking at every entry, so it's only done every EVICTRATE stores or
+so, letting the cache overshoot CACHEMAX a bit in between.
+
+NB: the cached json has the proctm of when it was first generated.
+"""
+
+from __future__ import print_function #py3
+import os, json, hashlib, shutil, uuid, random
+import bbio
+
+CACHEMAX = 1 << 30 # Evict least recently used entries beyond this many bytes
+EVICTRATE = 100    # Check the size of the cache on 1 in this many stores
+
+# Everything that affects what the graph looks like, besides the goal itself
+CODEFILES = ['blib.py', 'bsvg.py', 'bseries.py', 'bbio.py', 'beebrain.py',
+             'bullseye.png', 'infinity.png', 'smiley.png', 'jollyroger_sqr.png']
+# ...and the palette ImageMagick remaps the PNGs to, which blib leaves it to
+# find in the current directory, not next to blib
+PALETTE = 'palette.png'
+
+cver = None # memoized code version
+
+# Hash of the rendering code, so changing it invalidates every cached graph. A
+# missing file counts as a change too.
+def codever():
+  global cver
+  if cver is None:
+    here = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha1()
+    for f in [os.path.join(here, f) for f in CODEFILES] + \
+             [os.path.abspath(PALETTE)]:
+      h.update(f.encode('utf-8'))
+      try:
+        with open(f, 'rb') as fh: h.update(b':' + fh.read())
+      except (IOError, OSError): h.update(b'-') # no such file
+    cver = h.hexdigest()
+  return cver
+
+# Fingerprint of a goal's input files: the .bb file, its snapshot if that's what
+# bbio.load would use, and its log, if any (see bbio.py), plus the code version
+# and anything else the output depends on, like file names that end up in the
+# json. Nothing gets parsed, so it's sensitive to whitespace and such.
+def fingerprint(bbfile, extra=None):
+  h = hashlib.sha1()
+  for f in [bbfile, bbio.fresh(bbfile), bbio.logname(bbfile)]:
+    try:
+      with open(f, 'rb') as fh: b = fh.read()
+    except (TypeError, IOError, OSError): b = None # no such file (or f None)
+    h.update(b'-' if b is None else ('%d:' % len(b)).encode('utf-8') + b)
+  h.update(json.dumps([codever(), extra], sort_keys=True,
+                      separators=(',', ':')).encode('utf-8'))
+  return h.hexdigest()
+
+def entry(cdir, k): return os.path.join(cdir, k[:2], k)
+
+# Put a copy of src at dst, atomically, preferably as a hard link. (If dst is
+# already a link to src we're done, and have to be: renaming a link over another
+# link to the same file is a no-op that leaves the temp file behind.)
+def place(src, dst):
+  if os.path.exists(dst) and os.path.samefile(src, dst): return
+  tmp = dst + '-tmp' + uuid.uuid4().hex
+  try:             os.link(src, tmp)
+  except OSError:  shutil.copyfile(src, tmp)
+  os.rename(tmp, dst)
+
+# If the cache has an entry for key k then put its files in place as the files
+# named in the dict outs, eg {'json': 'foo.json', 'png': 'foo.png'}, and return
+# True. Otherwise return False and leave the file system alone.
+def fetch(cdir, k, outs):
+  e = entry(cdir, k)
+  if not all(os.path.isfile(os.path.join(e, n)) for n in outs): return False
+  try:
+    for n, f in sorted(outs.items()): place(os.path.join(e, n), f)
+    os.utime(e, None)
+  except (IOError, OSError): return False # evicted out from under us, say
+  return True
+
+# Add the files named in outs to the cache as the entry for key k. The entry is
+# assembled in a temp dir and renamed into place so a concurrent fetch sees all
+# of it or nothing; if some other process beat us to it, theirs wins.
+def store(cdir, k, outs):
+  e = entry(cdir, k)
+  if os.path.isdir(e): return
+  tmp = e + '-tmp' + uuid.uuid4().hex
+  try:
+    os.makedirs(tmp)
+    for n, f in outs.items():
+      try:            os.link(f, os.path.join(tmp, n))
+      except OSError: shutil.copyfile(f, os.path.join(tmp, n))
+    os.rename(tmp, e)
+  except (IOError, OSError): pass
+  if os.path.isdir(tmp): shutil.rmtree(tmp, ignore_errors=True)
+  # Chosen at random rather than counted since every process storing into the
+  # cache would need to share the count
+  if random.randrange(EVICTRATE) == 0: evict(cdir)
+
+# Delete least recently used entries till the cache is at most maxb bytes
+def evict(cdir, maxb=None):
+  maxb = CACHEMAX if maxb is None else maxb
+  ents = [] # (mtime, size, path) for each entry
+  for d in os.listdir(cdir):
+    d = os.path.join(cdir, d)
+    if not os.path.isdir(d): continue
+    for e in os.listdir(d):
+      e = os.path.join(d, e)
+      if '-tmp' in os.path.basename(e): continue
+      try:
+        size = sum(os.path.getsize(os.path.join(e, f)) for f in os.listdir(e))
+        ents.append((os.path.getmtime(e), size, e))
+      except OSError: continue # evicted by someone else
+  total = sum(s for (m, s, e) in ents)
+  for (m, s, e) in sorted(ents):
+    if total <= maxb: break
+    shutil.rmtree(e, ignore_errors=True)
+    total -= s
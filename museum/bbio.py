@@ -0,0 +1,359 @@
+"""
+Reading goal (.bb) files without materializing the data as nested lists.
+
+A .bb file is a JSON object with a "params" dict and a "data" list of rows like
+["20170101", 70.5, "comment"] where the timestamp may also be a unixtime. The
+params are parsed normally but the data is read incrementally, a chunk of the
+file at a time, straight into columns: arrays of timestamps and values plus a
+list of comments. A regex does the row matching so no per-row JSON decoding is
+needed except for comments with escapes in them.
+
+Usage:
+> j = load('foo.bb')                     # {'params': {...}, 'data': columns}
+> stats = blib.genStats(j['params'], j['data'])  # blib.stampIn unpacks it
+
+Anything irregular (rows that aren't [time, number, string], say, or keys
+other than params and data) makes load fall back on json.load, giving plain
+rows like it always did, so blib complains about bad datapoints exactly as
+before. Invalid JSON raises ValueError, same as json.load.
+
+Snapshots: a goal can also be saved as a binary .bbs file next to its .bb file
+(see bbsnap.py), which load then uses instead, as long as it's at least as new
+as the .bb file. The columns are laid out in it as raw arrays so load just
+memory-maps the file and points numpy at it; nothing is parsed but the header
+and the params, however long the goal's history. Comments are only decoded as
+they're looked up. The layout, all little-endian, each section padded to a
+multiple of 8 bytes:
+
+  header    "BBSN", version (uint32), n rows, params bytes, comments bytes
+            (uint64 each)
+  params    the params as JSON (utf-8)
+  t         unixtimes (float64 x n)
+  v         values (float64 x n)
+  tday      1 where the time was given as a daystamp (uint8 x n)
+  tint      1 where the time was given as an int unixtime (uint8 x n)
+  vint      1 where the value was an int (uint8 x n)
+  coff      where each comment starts in the string table, and where the last
+            one ends (int64 x n+1)
+  comments  the string table: all the comments, utf-8, end to end
+
+Version 1 snapshots, which had no tint and stored unixtimes as whole seconds
+(int64), can still be loaded.
+
+Logs: new datapoints needn't mean rewriting the whole goal file. They can be
+appended to a log, FILE.bbl, one JSON value per line: a row like
+["20170102", 71, "comment"] or a dict of params to change. Load reads the .bb
+file (or its snapshot) and then applies the log in order, and compacting the
+goal (bbsnap.py -c) folds the log back into whichever of those it came from and
+deletes the log.
+
+> append('foo.bb', [["20170102", 71, "comment"]], {'vfin': 80})
+
+Appending, loading and compacting all lock the log with flock -- shared for
+load, exclusive for the rest -- so no one sees a half-written line, nor the
+log and the goal it was folded into both at once.
+"""
+
+from __future__ import division #py3
+import io, os, re, json, time, calendar, struct, mmap, uuid
+import errno, fcntl, numbers
+from array import array
+from collections import namedtuple
+import numpy as np
+
+CHUNK = 1 << 16 # read this many characters at a time
+
+# The datapoints of a goal, as columns. t are unixtimes; tday says which ones
+# were given as daystamps (and so are already the start of the day) and tint
+# which were given as int unixtimes, so they can stay ints. v are the values;
+# vint says which ones were ints, likewise. c are the comments.
+Columns = namedtuple('Columns', 't tday tint v vint c')
+
+FRAC = r'(?:\.\d*)?(?:[eE][-+]?\d+)?'         # fractional part of a number
+NUM = r'(-?\d+(' + FRAC + r'))'              # a number, and its fractional part
+STR = r'"[^"\\]*(?:\\.[^"\\]*)*"'             # JSON string, with escapes
+ROW = re.compile(r'\s*\[\s*(?:"(\d{8})"|' + NUM + r')\s*,\s*' + NUM +
+                 r'\s*,\s*(' + STR + r')\s*\]\s*(,|\])', re.U)
+KEY = re.compile(r'\s*(' + STR + r')\s*:\s*', re.U)
+PUN = re.compile(r'\s*(\S)', re.U) # next punctuation, skipping whitespace
+
+days = {} # memoized daystamps; a goal has many datapoints on the same day
+
+# Unixtime of the start of the day given as a daystamp like "20170101", same as
+# blib.dayparse. UTC, like all of Beebrain's daystamps, even if blib (which sets
+# TZ to UTC) hasn't been imported.
+def daystamp(s):
+  if s not in days:
+    days[s] = calendar.timegm(time.strptime(s, "%Y%m%d"))
+  return days[s]
+
+class Unusual(Exception): pass # not a .bb file we can stream
+
+# A buffer of the file that fills up as regexes need more of it to match
+class Reader:
+  def __init__(self, f):
+    self.f = f
+    self.buf = u''
+    self.pos = 0
+    self.eof = False
+
+  def more(self):
+    s = self.f.read(CHUNK)
+    if not s: self.eof = True; return False
+    self.buf = self.buf[self.pos:] + s
+    self.pos = 0
+    return True
+
+  # Match regex r at the current position, reading more of the file as needed
+  def match(self, r):
+    while True:
+      m = r.match(self.buf, self.pos)
+      # A match that runs to the end of the buffer might go on past it
+      if m and (m.end() < len(self.buf) or self.eof): break
+      if not self.more():
+        m = r.match(self.buf, self.pos)
+        break
+    if m: self.pos = m.end()
+    return m
+
+  # The next non-whitespace character, consumed unless peek
+  def punc(self, peek=False):
+    m = self.match(PUN)
+    if m is None: raise Unusual
+    if peek: self.pos = m.start(1)
+    return m.group(1)
+
+  # Parse a JSON value at the current position
+  def value(self):
+    dec = json.JSONDecoder()
+    while True:
+      try:
+        while self.buf[self.pos:self.pos+1].isspace(): self.pos += 1
+        (x, end) = dec.raw_decode(self.buf, self.pos)
+        if end < len(self.buf) or self.eof:
+          self.pos = end
+          return x
+      except ValueError:
+        pass
+      if not self.more(): raise Unusual
+
+# Read the data array into columns, having read its opening bracket
+def rows(rd):
+  (t, tday, tint, v, vint, c) = (array('d'), array('b'), array('b'),
+                                 array('d'), array('b'), [])
+  end = rd.punc() if rd.punc(peek=True) == ']' else None # empty?
+  while end != ']':
+    m = ROW.match(rd.buf, rd.pos) # rd.match inlined, this being the hot loop
+    if m is None or m.end() == len(rd.buf): m = rd.match(ROW)
+    if m is None: raise Unusual
+    rd.pos = m.end()
+    (d, u, g, x, f, s, end) = m.groups()
+    t.append(daystamp(d) if d else float(u))
+    tday.append(1 if d else 0)
+    tint.append(0 if d or g else 1)
+    v.append(float(x))
+    vint.append(0 if f else 1)
+    c.append(json.loads(s) if '\\' in s else s[1:-1])
+  flags = lambda a: np.frombuffer(a, dtype=np.int8) != 0
+  return Columns(np.frombuffer(t), flags(tday), flags(tint),
+                 np.frombuffer(v), flags(vint), c)
+
+# Parse a .bb file as {'params': ..., 'data': Columns(...)}, a chunk at a time
+def stream(f):
+  rd = Reader(f)
+  out = {}
+  if rd.punc() != '{': raise Unusual
+  while True:
+    m = rd.match(KEY)
+    if m is None: raise Unusual
+    k = json.loads(m.group(1))
+    if k == 'params': out[k] = rd.value()
+    elif k == 'data':
+      if rd.punc() != '[': raise Unusual
+      out[k] = rows(rd)
+    else: raise Unusual
+    p = rd.punc()
+    if p == '}': break
+    if p != ',': raise Unusual
+  if not isinstance(out.get('params'), dict) or 'data' not in out:
+    raise Unusual
+  return out
+
+# Binary snapshots (see above)
+MAGIC   = b'BBSN'
+VERSION = 2
+HEAD    = struct.Struct('<4sIQQQ') # magic, version, n, params len, comments len
+
+# Round up to a multiple of 8 bytes
+def pad8(n): return (n + 7) // 8 * 8
+
+# Comments in a snapshot, decoded from the string table only when looked up
+class Strings:
+  def __init__(self, buf, at, off):
+    self.buf = buf  # the whole snapshot
+    self.at = at    # where the string table starts in it
+    self.off = off  # offsets into that, one more than there are comments
+  def __len__(self): return len(self.off) - 1
+  def __getitem__(self, i):
+    if not 0 <= i < len(self): raise IndexError(i)
+    (a, b) = (self.at + int(self.off[i]), self.at + int(self.off[i+1]))
+    return self.buf[a:b].decode('utf-8')
+
+# Name of the snapshot of a given .bb file
+def snapname(bbfile): return os.path.splitext(bbfile)[0] + '.bbs'
+
+# Serialize {'params': ..., 'data': Columns(...)} as a snapshot (a bytestring)
+def pack(j):
+  d = j['data']
+  if not isinstance(d, Columns): raise Unusual
+  p = json.dumps(j['params'], separators=(',',':')).encode('utf-8')
+  cs = [c.encode('utf-8') for c in d.c]
+  coff = np.zeros(len(cs)+1, dtype='<i8')
+  coff[1:] = np.cumsum([len(c) for c in cs])
+  cb = b''.join(cs)
+  out = [HEAD.pack(MAGIC, VERSION, len(d.t), len(p), len(cb)), p,
+         d.t.astype('<f8').tobytes(), d.v.astype('<f8').tobytes(),
+         d.tday.astype('u1').tobytes(), d.tint.astype('u1').tobytes(),
+         d.vint.astype('u1').tobytes(),
+         coff.tobytes(), cb]
+  return b''.join(x + b'\0'*(pad8(len(x)) - len(x)) for x in out)
+
+# Write the snapshot of a parsed .bb file atomically, so a concurrent load never
+# sees half of it
+def save(j, snapfile):
+  tmp = snapfile + '-tmp' + uuid.uuid4().hex
+  with open(tmp, 'wb') as f: f.write(pack(j))
+  os.rename(tmp, snapfile)
+
+# Load a snapshot as {'params': ..., 'data': Columns(...)} with the columns
+# pointing straight into the memory-mapped file. ValueError if it's not one.
+def snapload(snapfile):
+  with open(snapfile, 'rb') as f:
+    if os.fstat(f.fileno()).st_size < HEAD.size: raise ValueError(snapfile)
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  (magic, ver, n, plen, clen) = HEAD.unpack_from(buf, 0)
+  if magic != MAGIC or ver not in (1, VERSION): raise ValueError(snapfile)
+  at = [pad8(HEAD.size)]
+  for size in [plen, 8*n, 8*n, n] + [n]*(ver > 1) + [n, 8*(n+1), clen]:
+    at.append(at[-1] + pad8(size))
+  if len(buf) < at[-1]: raise ValueError(snapfile) # truncated
+  col = lambda k, dt, m: np.frombuffer(buf, dtype=dt, count=m, offset=at[k])
+  if ver == 1: # whole-second unixtimes and no tint
+    tday = col(3, 'u1', n).view(bool)
+    data = Columns(col(1, '<i8', n), tday, ~tday,
+                   col(2, '<f8', n), col(4, 'u1', n).view(bool),
+                   Strings(buf, at[6], col(5, '<i8', n+1)))
+  else:
+    data = Columns(col(1, '<f8', n), col(3, 'u1', n).view(bool),
+                   col(4, 'u1', n).view(bool),
+                   col(2, '<f8', n), col(5, 'u1', n).view(bool),
+                   Strings(buf, at[7], col(6, '<i8', n+1)))
+  return {'params': json.loads(buf[at[0]:at[0]+plen].decode('utf-8')),
+          'data': data}
+
+# The snapshot of a .bb file if there's an up-to-date one, else None
+def fresh(bbfile):
+  snap = snapname(bbfile)
+  try:    return snap if os.path.getmtime(snap) >= os.path.getmtime(bbfile) \
+                 else None
+  except OSError: return None
+
+# Parse a .bb file, streaming the data into columns if it's a regular one, or
+# just map its snapshot if there's an up-to-date one. Ignores the log.
+def loadbase(bbfile):
+  snap = fresh(bbfile)
+  try:
+    if snap: return snapload(snap)
+  except (IOError, OSError, ValueError, struct.error): pass
+  try:
+    with io.open(bbfile, encoding='utf-8') as f: return stream(f)
+  except (Unusual, ValueError, UnicodeError): pass
+  with io.open(bbfile, encoding='utf-8') as f: return json.load(f)
+
+# Name of the log of a given .bb file
+def logname(bbfile): return os.path.splitext(bbfile)[0] + '.bbl'
+
+# Open and flock the log, shared or exclusive (fcntl.LOCK_SH or LOCK_EX),
+# creating it if create, else returning None if there isn't one. If the log was
+# compacted away while we waited for the lock, we've locked a deleted file, so
+# start over with whatever is there now.
+def openlog(logfile, how, create=False):
+  while True:
+    try: f = io.open(logfile, 'a+b' if create else 'rb')
+    except IOError as e:
+      if e.errno == errno.ENOENT: return None
+      raise
+    fcntl.flock(f.fileno(), how)
+    try:            ino = os.stat(logfile).st_ino
+    except OSError: ino = None
+    if ino == os.fstat(f.fileno()).st_ino: return f
+    f.close()
+
+# Append datapoints (rows like [t,v,c]) and/or a dict of param changes to the
+# log of a .bb file, in one write. If the last write got cut off (see merge),
+# start on a fresh line.
+def append(bbfile, rows=[], params=None):
+  lines = [json.dumps(r, separators=(',',':')) + '\n' for r in rows]
+  if params: lines.append(json.dumps(params, separators=(',',':')) + '\n')
+  f = openlog(logname(bbfile), fcntl.LOCK_EX, create=True)
+  try:
+    f.seek(0, io.SEEK_END)
+    if f.tell() > 0:
+      f.seek(-1, io.SEEK_END)
+      if f.read(1) != b'\n': lines.insert(0, '\n')
+    f.write(''.join(lines).encode('utf-8'))
+  finally: f.close()
+
+# The datapoints as rows like [t,v,c] the way a .bb file would have them:
+# daystamps where the times were given as daystamps, ints for the times and
+# values that were ints
+def unrows(d):
+  if not isinstance(d, Columns): return list(d)
+  return [[time.strftime('%Y%m%d', time.gmtime(t)) if dy else
+           int(t) if ti else t, int(v) if vi else v, c]
+          for (t, dy, ti, v, vi, c) in zip(d.t.tolist(), d.tday.tolist(),
+                                           d.tint.tolist(), d.v.tolist(),
+                                           d.vint.tolist(), d.c)]
+
+# A datapoint as it would have come out of rows, or None if it's irregular
+def regular(r):
+  num = lambda x: isinstance(x, numbers.Real) and not isinstance(x, bool)
+  if not isinstance(r, list) or len(r) != 3: return None
+  (t, v, c) = r
+  day = isinstance(t, type(u'')) and re.match(r'\d{8}$', t) is not None #py3 str
+  if not (day or num(t)) or not num(v) or not isinstance(c, type(u'')):
+    return None
+  return (daystamp(t) if day else float(t), day,
+          not day and not isinstance(t, float), float(v),
+          not isinstance(v, float), c)
+
+# Apply the lines of a log (a bytestring) to a parsed .bb file, in place.
+# Writes happen under the lock in one go, so a line that doesn't parse can only
+# be one that got cut off by the writer dying; skip it.
+def merge(j, log):
+  if not isinstance(j, dict) or not isinstance(j.get('params'), dict): return j
+  (rows, d) = ([], j.get('data'))
+  for line in log.split(b'\n'):
+    try:               x = json.loads(line.decode('utf-8'))
+    except ValueError: continue
+    if isinstance(x, dict): j['params'].update(x)
+    else: rows.append(x)
+  if not rows: return j
+  new = [regular(r) for r in rows]
+  if isinstance(d, Columns) and None not in new:
+    (t, tday, tint, v, vint, c) = zip(*new)
+    j['data'] = Columns(np.concatenate([d.t, t]),
+                        np.concatenate([d.tday, np.array(tday, dtype=bool)]),
+                        np.concatenate([d.tint, np.array(tint, dtype=bool)]),
+                        np.concatenate([d.v, v]),
+                        np.concatenate([d.vint, np.array(vint, dtype=bool)]),
+                        list(d.c) + list(c))
+  elif isinstance(d, (Columns, list)): j['data'] = unrows(d) + rows
+  return j
+
+# Load a goal: the .bb file (or its snapshot) with its log, if any, applied
+def load(bbfile):
+  f = openlog(logname(bbfile), fcntl.LOCK_SH)
+  if f is None: return loadbase(bbfile)
+  try:     return merge(loadbase(bbfile), f.read())
+  finally: f.close()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Tests for bbio.py: streaming, snapshots and logs of .bb files.
+# Run with ./bbio_test.py or pytest.
+
+import os, json, time, shutil, tempfile, unittest
+import bbio, bbsnap
+
+BB = {"params": {"yaw": 1, "dir": 1, "vfin": 80, "tfin": "20170301",
+                 "road": [["20170201", None, 0.5]]},
+      "data": [["20170101", 70, "first"],
+               ["20170102", 70.5, "with \"quotes\""],
+               ["20170102", 71, ""],
+               ["20170110", -2.25, u"and a unicode \u2603"],
+               [1484092800, 72, "int unixtime"],
+               [1484179200.5, 72.5, "fractional unixtime"]]}
+
+# Midnight UTC at the start of each of the daystamps above
+UTC = {"20170101": 1483228800, "20170102": 1483315200,
+       "20170110": 1484006400}
+
+# The unixtimes bbio should make of the datapoints above
+def times(rows): return [UTC.get(t, t) for (t, v, c) in rows]
+
+def slurp(f):
+  with open(f, 'rb') as fh: return fh.read()
+
+# Canonical JSON, so 1484092800.0 doesn't pass for 1484092800 as it would in an
+# assertEqual of the parsed values
+def canon(x):
+  if isinstance(x, bytes): x = json.loads(x.decode('utf-8'))
+  return json.dumps(x, sort_keys=True)
+
+class Local(unittest.TestCase):
+  # Everything in a scratch dir, in a time zone other than UTC, which is where
+  # bbio used to get the days wrong
+  def setUp(self):
+    self.tz = os.environ.get('TZ')
+    os.environ['TZ'] = 'America/New_York'; time.tzset()
+    bbio.days.clear()
+    self.dir = tempfile.mkdtemp()
+    self.bb = os.path.join(self.dir, 'goal.bb')
+    with open(self.bb, 'wb') as f: f.write(json.dumps(BB).encode('utf-8'))
+
+  def tearDown(self):
+    if self.tz is None: del os.environ['TZ']
+    else: os.environ['TZ'] = self.tz
+    time.tzset()
+    bbio.days.clear()
+    shutil.rmtree(self.dir)
+
+class TestSnapshot(Local):
+  def test_daystamps_are_utc(self):
+    d = bbio.load(self.bb)['data']
+    self.assertIsInstance(d, bbio.Columns)
+    self.assertEqual(d.t.tolist(), times(BB['data']))
+
+  def test_roundtrip(self):
+    bbio.save(bbio.load(self.bb), bbio.snapname(self.bb))
+    j = bbio.snapload(bbio.snapname(self.bb))
+    self.assertEqual(j['params'], BB['params'])
+    self.assertEqual(j['data'].t.tolist(), times(BB['data']))
+    self.assertEqual(canon(bbio.unrows(j['data'])), canon(BB['data']))
+
+class TestCompact(Local):
+  def test_no_log(self):
+    bbsnap.writebb(bbio.load(self.bb), self.bb)
+    self.assertEqual(canon(slurp(self.bb)), canon(BB))
+    before = slurp(self.bb)
+    bbsnap.writebb(bbio.load(self.bb), self.bb)
+    self.assertEqual(slurp(self.bb), before)
+    bbsnap.compact(self.bb)
+    self.assertEqual(slurp(self.bb), before)
+
+  def test_log(self):
+    rows = [["20170111", 73, "logged"], [1484265600, 74, ""]]
+    bbio.append(self.bb, rows[:1])
+    bbio.append(self.bb, rows[1:], {'vfin': 90})
+    bbsnap.compact(self.bb)
+    self.assertFalse(os.path.exists(bbio.logname(self.bb)))
+    want = json.loads(json.dumps(BB))
+    want['data'] += rows
+    want['params']['vfin'] = 90
+    self.assertEqual(canon(slurp(self.bb)), canon(want))
+
+  def test_log_into_snapshot(self):
+    (snap, want) = (bbio.snapname(self.bb), json.loads(json.dumps(BB)))
+    want['data'].append([1484265600, 74, ""])
+    bbsnap.snap(self.bb)
+    bbio.append(self.bb, want['data'][-1:])
+    bbsnap.compact(self.bb)
+    self.assertEqual(canon(bbio.unrows(bbio.snapload(snap)['data'])),
+                     canon(want['data']))
+    bbsnap.unsnap(snap)
+    self.assertEqual(canon(slurp(self.bb)), canon(want))
+
+if __name__ == '__main__':
+  unittest.main()
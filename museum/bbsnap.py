@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Convert goal files to and from binary snapshots (see bbio.py).
+# Usage: ./bbsnap.py FILE.bb [FILE.bb ...]     writes FILE.bbs next to each
+#        ./bbsnap.py -x FILE.bbs [...]         writes FILE.bb back out of each
+#        ./bbsnap.py -c FILE.bb [...]          compacts each goal's log
+# A snapshot only gets used in place of its .bb file while it's at least as new,
+# so editing the .bb file makes beebrain ignore the stale snapshot. With -x the
+# .bb file is written one datapoint per line, like jsunnier.py does, and if it
+# already exists it's backed up to FILE.bb.bak first.
+# With -c the datapoints and param changes appended to FILE.bbl are folded into
+# the snapshot, if the goal has an up-to-date one, else into the .bb file, and
+# the log is deleted.
+
+from __future__ import print_function #py3
+import sys, os, io, json, shutil, getopt, fcntl
+import bbio
+
+def usage():
+  print("Usage: bbsnap.py [-x|-c] FILE [FILE ...]")
+  print("Converts bb JSON files to binary .bbs snapshots, or back with -x.")
+  print("With -c folds the log of appended datapoints into each goal instead.")
+  sys.exit(1)
+
+def dumpit(x):
+  # No spaces after separators; keep inner arrays on one line.
+  return json.dumps(x, ensure_ascii=False, separators=(",", ":"))
+
+# Write a parsed goal as a .bb file, params first and then one datapoint per
+# line, backing up the existing one if bak
+def writebb(j, bbfile, bak=False):
+  rest = [k for k in j if k not in ["params", "data"]] # irregular, but keep 'em
+  out = ['{"params":' + dumpit(j["params"]) + ",", '"data":[']
+  out.append(",\n".join(dumpit(r) for r in bbio.unrows(j["data"])))
+  out.append("]" + "".join("," + dumpit(k) + ":" + dumpit(j[k]) for k in rest)
+             + "}\n")
+  if bak and os.path.exists(bbfile): shutil.copy2(bbfile, bbfile + ".bak")
+  tmp = bbfile + ".tmp"
+  with io.open(tmp, "w", encoding="utf-8") as f:
+    f.write(u"\n".join(out)) #py3 no u
+  os.rename(tmp, bbfile)
+
+# Snapshot a .bb file; returns an error message or None
+def snap(bbfile):
+  try: j = bbio.load(bbfile)
+  except IOError as e: return "Error reading file: " + str(e)
+  except ValueError as e: return "Error! File is not valid JSON: " + str(e)
+  if not isinstance(j.get("data"), bbio.Columns):
+    return "Error! Not a regular bb file (every datapoint [time,value,comment])"
+  bbio.save(j, bbio.snapname(bbfile))
+  print("Snapshotted", bbfile, "as", bbio.snapname(bbfile))
+
+# Write a snapshot back out as a .bb file; returns an error message or None
+def unsnap(snapfile):
+  try: j = bbio.snapload(snapfile)
+  except (IOError, ValueError) as e: return "Error! Not a snapshot: " + str(e)
+  bbfile = os.path.splitext(snapfile)[0] + ".bb"
+  writebb(j, bbfile, bak=True)
+  os.utime(snapfile, None) # the .bb file mustn't look newer than its snapshot
+  print("Wrote", bbfile)
+
+# Fold a goal's log into its snapshot or .bb file; returns an error message or
+# None. Holds the log's lock throughout so nothing gets appended to the log in
+# the meantime and no one loads the goal half compacted.
+def compact(bbfile):
+  logfile = bbio.logname(bbfile)
+  f = bbio.openlog(logfile, fcntl.LOCK_EX)
+  if f is None: print("Nothing to compact for", bbfile); return
+  try:
+    snap = bbio.fresh(bbfile)
+    try: j = bbio.merge(bbio.loadbase(bbfile), f.read())
+    except IOError as e: return "Error reading file: " + str(e)
+    except ValueError as e: return "Error! File is not valid JSON: " + str(e)
+    if not isinstance(j, dict) or not isinstance(j.get("params"), dict):
+      return "Error! Not a bb file? Expected 'params' dict. Aborting."
+    if snap and isinstance(j.get("data"), bbio.Columns): bbio.save(j, snap)
+    else: snap = None; writebb(j, bbfile)
+    os.remove(logfile)
+    print("Compacted", logfile, "into", snap or bbfile)
+  finally: f.close()
+
+def main(argv):
+  try: opts, args = getopt.getopt(argv, "hxc")
+  except getopt.GetoptError: usage()
+  conv = snap
+  for opt, arg in opts:
+    if   opt == '-h': usage()
+    elif opt == '-x': conv = unsnap
+    elif opt == '-c': conv = compact
+  if len(args) < 1: usage()
+  ok = True
+  for f in args:
+    err = conv(f)
+    if err: print(f + ":", err, file=sys.stderr); ok = False
+  if not ok: sys.exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -1,19 +1,46 @@
 #!/usr/bin/env python
-# Command-line interface to Beebrain. 
-# The php wrapper (now Rails api endpoint) writes a .bb file which the daemon 
-# notices and calls this script with. 
-# This script writes a corresponding .json file which should happen almost 
+# Command-line interface to Beebrain.
+# The php wrapper (now Rails api endpoint) writes a .bb file which the daemon
+# notices and calls this script with.
+# This script writes a corresponding .json file which should happen almost
 # immediately and then writes the .png files for the graph and the thumbnail
 # when they're done generating, a couple seconds later.
 # To avoid the images being fetched when partially rendered, we generate them
 # as temp files and then copy them to their proper file names when finished.
 # Finally, if the slug has the special prefix "NOGRAPH_" then we don't generate
 # the graph image or thumbnail.
+#
+# Pipelined mode: "beebrain.py -j N bbfile1 bbfile2 ..." computes the stats and
+# writes the .json for each goal in turn but hands the rendering off to a forked
+# child process, at most N of them at once. The child inherits blib's globals
+# exactly as genStats left them -- a frozen goal state -- so the next goal's
+# stats can be computed while the previous goals' images are still rendering.
+# Without -j (or with -j 0) everything happens in this process, one goal at a
+# time, like it always did.
+#
+# With -s it also writes an .svg of the graph (see bsvg.py) next to the .png.
+# With -c DIR it keeps a cache of everything it writes in DIR, keyed by the
+# fingerprint of the goal's input files and the code (see bbcache.py), and if
+# that's been seen before it just links the cached files into place instead,
+# without parsing the goal.
+# With -t FILE it records how long each phase of each goal takes, adds that to
+# the .json as 'timings', and writes the totals across all the goals to FILE.
+# (In pipelined mode that only covers the stats, the rendering being elsewhere.)
+#
+# Next to the outputs goes a .fp file with a fingerprint of the inputs they were
+# generated from (see bbcache.fingerprint). If the inputs and the code are
+# byte-identical to last time and the outputs are all still there, there's
+# nothing to do and we skip the goal without so much as parsing it, just
+# touching the .json with -T so it looks freshly generated. -F forces it anyway.
 
 from __future__ import print_function #py3
 import time; starttm = time.time() # timstamp that beebrain was called #########
-import sys, os, re, json
+import sys, os, re, json, getopt
+import multiprocessing as mp
 import blib as bb
+import bsvg
+import bbcache
+import bbio
 #import mpld3
 
 BBURL = "http://brain.beeminder.com/"
@@ -21,71 +48,196 @@ BBURL = "http://brain.beeminder.com/"
 # Whether it's a special slug indicating we shouldn't actually draw the graph
 def nograph(slug): return re.match('NOGRAPH_', slug)
 
-if len(sys.argv) < 2: print('USAGE:', sys.argv[0], 'bbfile'); exit(1)
-
-print('<BEEBRAIN> ', end=''); sys.stdout.flush()
-
-os.umask(0) # write files sluttily; unix file permissions can (and do) bite me.
-
-bbfile = sys.argv[1]                       # Verify and decompose BB filename...
-if not os.path.isfile(bbfile): print('Not a beebrain file:',bbfile); exit(1)
-
-m = re.match(r"""(.*?)     # base: everything up to the last slash
-                 ([^\/]+)  # slug: everything between last slash and '.bb'
-                 \.bb$""", bbfile, re.X)
-if m == None: print('ERROR:', bbfile, 'not a bbfile!'); exit(1)
-base  = m.group(1)
-slug  = m.group(2)  # typically like "alice+foo+nonce"
-sluga = re.sub("^([^\+]*\+[^\+]*).*", r'\1', slug) # slug, abbreviated
-
-print('{} @ {}'.format(sluga, bb.shdt(starttm)))
-imgf = base + ("NOGRAPH" if nograph(slug) else slug) + '.png'
-thmf = base + ("NOGRAPH" if nograph(slug) else slug) + '-thumb.png'
-#d3f  = base + ("NOGRAPH" if nograph(slug) else slug) + '-d3.json'
-# generate the graph unless both nograph(slug) and nograph.png already exists
-graphit = not(nograph(slug) and os.path.exists(imgf) and os.path.exists(thmf))
-if graphit:
-  imgftmp = bb.tempify(imgf)                   # Make sure the images 404
-  thmftmp = bb.tempify(thmf)                   #   until they're ready...
-  #d3ftmp  = bb.tempify(d3f)
-  #if os.path.exists(imgf): os.rename(imgf, imgftmp) # SCHDEL: this confused
-  #if os.path.exists(thmf): os.rename(thmf, thmftmp) # Preview.app in devel for
-  if os.path.exists(imgf): os.remove(imgf)           # me and shouldn't matter
-  if os.path.exists(thmf): os.remove(thmf)           # if you remove vs rename
-  #if os.path.exists(d3f):  os.remove(d3f)
-
-try:               j = json.load(open(bbfile))    # parse .bb file
-except ValueError: print("Couldn't parse",bbfile,"as JSON; aborting!"); exit(1)
-# if generating the NOGRAPH graph, set yoog=NOGRAPH so beebrain knows to make it
-if nograph(slug) and graphit: j['params']['yoog'] = "NOGRAPH"
-stats = bb.genStats(j['params'], j['data'])       # compute the stats
-proctm = stats['proctm']
-statstm = time.time()                             # done generating stats ######
-print(re.sub(r'\\n', '\n', stats['statsum']), sep='', end='')
-stats["graphurl"] = BBURL+imgf
-stats["thumburl"] = BBURL+thmf
-jf = base+slug+'.json'                           # write .json to a temp file
-jtmp = bb.tempify(jf)                            #   first, otherwise we could
-if os.path.exists(jf): os.rename(jf, jtmp)       #   end up trying to read it
-json.dump(stats, open(jtmp, 'w'))                #   before it's completely 
-os.rename(jtmp, jf)                              #   written.
-
-if graphit: 
-  bb.genGraph()                        # generate the graph
-  
-  #mpld3.show()
-  #json.dump(mpld3.fig_to_dict(bb.plt.gcf()), open(d3ftmp, 'w'))
-  #os.rename(d3ftmp, d3f)
-
-graphtm = time.time()                            # done generating the graph ###
-if graphit:
-  bb.genImage(imgftmp); os.rename(imgftmp, imgf) # write the image file
-  bb.genThumb(thmftmp); os.rename(thmftmp, thmf) # write the thumb file
-
-donetm = time.time()                             # done generating the images ##
-tottime = donetm - proctm
-print("</BEEBRAIN> ", bb.shn(proctm -starttm, 1,3), " load + ", \
-                      bb.shn(statstm-proctm,  1,3), " stats + ", \
-                      bb.shn(graphtm-statstm, 1,3), " graph + ", \
-                      bb.shn(donetm -graphtm, 1,3), " images = ", \
-                      bb.shn(donetm -starttm, 1,3), "s", sep='')
+def usage():
+  print('USAGE:', sys.argv[0], '[-j N] [-s] [-c DIR] [-t FILE] [-T] [-F]',
+                               'bbfile [bbfile ...]')
+  print('  -j N: render graphs in up to N background processes (default 0)')
+  print('  -s:   also write an svg version of the graph')
+  print('  -c DIR: reuse output for unchanged goals from the cache in DIR')
+  print('  -t FILE: time the phases of beebrain and write the totals to FILE')
+  print('  -T:   touch the json of goals skipped for being unchanged')
+  print('  -F:   regenerate everything even if the inputs are unchanged')
+  exit(1)
+
+# Whether the outputs (a dict like outs in brain) are all there and were made
+# from inputs with fingerprint fp, going by the fingerprint file fpf
+def unchanged(fpf, fp, outs):
+  if not all(os.path.exists(f) for f in outs.values()): return False
+  try:               return open(fpf).read().strip() == fp
+  except IOError:    return False
+
+# Record the fingerprint of the inputs the outputs were made from
+def stampfp(fpf, fp):
+  tmp = bb.tempify(fpf)
+  with open(tmp, 'w') as f: f.write(fp + '\n')
+  os.rename(tmp, fpf)
+
+# Render processes still running in pipelined mode, with their bbfiles
+kids = []
+
+# Wait till fewer than n render processes are running. Returns False if any of
+# the ones that finished failed.
+def reap(n):
+  ok = True
+  while True:
+    for (k, bbfile) in kids:
+      if k.is_alive() or k.exitcode == 0: continue
+      print('ERROR: rendering', bbfile, 'failed with exit code', k.exitcode)
+      sys.stdout.flush()
+      ok = False
+    kids[:] = [(k, bbfile) for (k, bbfile) in kids if k.is_alive()]
+    if len(kids) < n: return ok
+    kids[0][0].join(.05)
+
+# Compute the stats for the given bbfile and write the .json file. Returns a
+# function that generates the images, or None if there's nothing more to do.
+# The function returned closes over file names and timestamps, not blib state,
+# so it must be called before genStats is called again (or in a forked child).
+def brain(bbfile, starttm=None, svg=False, cdir=None, touch=False,
+          force=False):
+  starttm = starttm or time.time()
+  print('<BEEBRAIN> ', end=''); sys.stdout.flush()
+
+  if not os.path.isfile(bbfile): print('Not a beebrain file:',bbfile); return
+
+  m = re.match(r"""(.*?)     # base: everything up to the last slash
+                   ([^\/]+)  # slug: everything between last slash and '.bb'
+                   \.bb$""", bbfile, re.X)
+  if m == None: print('ERROR:', bbfile, 'not a bbfile!'); return
+  base  = m.group(1)
+  slug  = m.group(2)  # typically like "alice+foo+nonce"
+  sluga = re.sub("^([^\+]*\+[^\+]*).*", r'\1', slug) # slug, abbreviated
+
+  print('{} @ {}'.format(sluga, bb.shdt(starttm)))
+  imgf = base + ("NOGRAPH" if nograph(slug) else slug) + '.png'
+  thmf = base + ("NOGRAPH" if nograph(slug) else slug) + '-thumb.png'
+  svgf = base + ("NOGRAPH" if nograph(slug) else slug) + '.svg'
+  jf   = base + slug + '.json'
+  fpf  = base + slug + '.fp'
+  #d3f  = base + ("NOGRAPH" if nograph(slug) else slug) + '-d3.json'
+  # generate the graph unless both nograph(slug) and nograph.png already exists
+  graphit = not(nograph(slug) and os.path.exists(imgf) and os.path.exists(thmf))
+
+  outs = { 'json': jf } # everything we write, by name in the cache
+  if graphit:         outs.update({ 'png': imgf, 'thumb': thmf })
+  if graphit and svg: outs['svg'] = svgf
+
+  # (With -t the json gets timings so that's part of what it's generated from)
+  fp = bbcache.fingerprint(bbfile, [BBURL, sorted(outs.items()), bb.TIMING])
+  if not force and unchanged(fpf, fp, outs):
+    print('Unchanged since last time; skipping')
+    if touch: os.utime(jf, None)
+    def skipped(bg=False):
+      print("</BEEBRAIN> unchanged = ", bb.shn(time.time()-starttm, 1,3), "s",
+            " ("+sluga+")" if bg else "", sep='')
+      sys.stdout.flush()
+    return skipped
+  if os.path.exists(fpf): os.remove(fpf) # the outputs are about to change
+
+  if cdir is not None and bbcache.fetch(cdir, fp, outs):
+    stampfp(fpf, fp)
+    print('Unchanged; using cached', ', '.join(sorted(outs)))
+    def cached(bg=False):
+      print("</BEEBRAIN> cache hit = ", bb.shn(time.time()-starttm, 1,3), "s",
+            " ("+sluga+")" if bg else "", sep='')
+      sys.stdout.flush()
+    return cached
+
+  try:               j = bbio.load(bbfile)          # parse .bb file
+  except ValueError: print("Couldn't parse",bbfile,"as JSON; aborting!"); return
+  # if generating the NOGRAPH graph, set yoog=NOGRAPH so beebrain knows to make it
+  if nograph(slug) and graphit: j['params']['yoog'] = "NOGRAPH"
+
+  if graphit:
+    imgftmp = bb.tempify(imgf)                   # Make sure the images 404
+    thmftmp = bb.tempify(thmf)                   #   until they're ready...
+    #d3ftmp  = bb.tempify(d3f)
+    #if os.path.exists(imgf): os.rename(imgf, imgftmp) # SCHDEL: this confused
+    #if os.path.exists(thmf): os.rename(thmf, thmftmp) # Preview.app in devel for
+    if os.path.exists(imgf): os.remove(imgf)           # me and shouldn't matter
+    if os.path.exists(thmf): os.remove(thmf)           # if you remove vs rename
+    #if os.path.exists(d3f):  os.remove(d3f)
+
+  stats = bb.genStats(j['params'], j['data'])       # compute the stats
+  proctm = stats['proctm']
+  statstm = time.time()                             # done generating stats ####
+  print(re.sub(r'\\n', '\n', stats['statsum']), sep='', end='')
+  stats["graphurl"] = BBURL+imgf
+  stats["thumburl"] = BBURL+thmf
+  jtmp = bb.tempify(jf)                            # write .json to a temp file
+  if os.path.exists(jf): os.remove(jf)             #   first, otherwise we could
+  json.dump(stats, open(jtmp, 'w'))                #   end up trying to read it
+  os.rename(jtmp, jf)                              #   before it's completely
+                                                   #   written. (Never write
+                                                   #   over jf in place, it may
+                                                   #   be linked to the cache.)
+  sys.stdout.flush()
+
+  # If bg then we're in a render process so say which goal we're done with
+  def render(bg=False):
+    gstarttm = time.time()
+    if graphit:
+      bb.genGraph()                        # generate the graph
+
+      #mpld3.show()
+      #json.dump(mpld3.fig_to_dict(bb.plt.gcf()), open(d3ftmp, 'w'))
+      #os.rename(d3ftmp, d3f)
+
+    graphtm = time.time()                          # done generating the graph #
+    if graphit:
+      bb.genImage(imgftmp); os.rename(imgftmp, imgf) # write the image file
+      bb.genThumb(thmftmp); os.rename(thmftmp, thmf) # write the thumb file
+    if graphit and svg:
+      svgftmp = bb.tempify(svgf)
+      bsvg.genSVG(svgftmp); os.rename(svgftmp, svgf) # write the svg file
+
+    donetm = time.time()                           # done generating the images
+    if cdir is not None: bbcache.store(cdir, fp, outs)
+    stampfp(fpf, fp)
+    print("</BEEBRAIN> ", bb.shn(proctm  -starttm,  1,3), " load + ", \
+                          bb.shn(statstm -proctm,   1,3), " stats + ", \
+                          bb.shn(graphtm -gstarttm, 1,3), " graph + ", \
+                          bb.shn(donetm  -graphtm,  1,3), " images = ", \
+                          bb.shn(donetm  -starttm,  1,3), "s", \
+                          " ("+sluga+")" if bg else "", \
+                          sep='')
+    sys.stdout.flush()
+  return render
+
+def main(argv):
+  try: opts, args = getopt.getopt(argv, "hj:sc:t:TF")
+  except getopt.GetoptError: usage()
+  nproc = 0 # number of render processes; 0 means render in this process
+  svg = False
+  cdir = None # cache directory; None means don't cache
+  tf = None   # where to write the timing totals; None means don't time things
+  touch = False # whether to touch the json of goals skipped as unchanged
+  force = False # whether to regenerate goals even if they're unchanged
+  for opt, arg in opts:
+    if   opt == '-h': usage()
+    elif opt == '-j': nproc = int(arg)
+    elif opt == '-s': svg = True
+    elif opt == '-c': cdir = arg
+    elif opt == '-t': tf = arg; bb.TIMING = True
+    elif opt == '-T': touch = True
+    elif opt == '-F': force = True
+  if len(args) < 1: usage()
+
+  os.umask(0) # write files sluttily; unix file permissions can (and do) bite me
+
+  ok = True
+  for i, bbfile in enumerate(args):
+    render = brain(bbfile, starttm if i == 0 else None, svg, cdir, touch, force)
+    if render is None: ok = False; continue
+    if nproc <= 0: render(); continue
+    if not reap(nproc): ok = False
+    kid = mp.Process(target=render, args=(True,)) # forked: gets blib's globals
+    kid.start()
+    kids.append((kid, bbfile))
+  if not reap(1): ok = False
+  if tf is not None: json.dump(bb.timingsOut(bb.tallies), open(tf, 'w'),
+                               indent=1, sort_keys=True)
+  if not ok: exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Benchmark for Beebrain: times genStats, genGraph, genImage and genThumb on
+# each .bb file (by default the ones in automon/data), repeating each run a few
+# times and reporting the median and 95th percentile per phase per goal.
+#
+# Save the results as a baseline with -o and compare a later run against it
+# with -b; any phase of any goal whose median got slower by more than the
+# threshold (-t, a fraction, default .2) is flagged as a regression and we exit
+# with status 1. Phases faster than NOISE seconds are too noisy to flag.
+#
+# Examples:
+#   ./bench.py -n 5 -o base.json             # record a baseline
+#   ./bench.py -n 5 -b base.json             # did we make anything slower?
+#   ./bench.py -b base.json -t .1 ~/goals/   # any dirs or .bb files work too
+
+from __future__ import print_function #py3
+from __future__ import division #py3
+import sys, os, json, glob, getopt, shutil, tempfile, time
+import numpy as np
+import blib as bb
+import bbio
+
+HERE   = os.path.dirname(os.path.abspath(__file__))
+DATA   = os.path.join(HERE, '..', 'automon', 'data')
+PHASES = ['genStats', 'genGraph', 'genImage', 'genThumb']
+NOISE  = .005 # don't flag regressions in phases that take less than this (s)
+
+def usage():
+  print('USAGE:', sys.argv[0], '[-n N] [-o OUT] [-b BASE] [-t T]',
+                               '[bbfile|dir ...]')
+  print('  -n N:    run each goal N times (default 5)')
+  print('  -o OUT:  save the results as a json baseline to OUT')
+  print('  -b BASE: flag regressions relative to the baseline in BASE')
+  print('  -t T:    regression threshold, fraction of baseline (default .2)')
+  exit(1)
+
+# All the .bb files in the given files and directories
+def bbfiles(args):
+  out = []
+  for a in args:
+    if os.path.isdir(a): out += sorted(glob.glob(os.path.join(a, '*.bb')))
+    else:                out.append(a)
+  return [os.path.abspath(f) for f in out]
+
+# Time each phase for bbfile n times; returns {phase: [seconds, ...]}
+def bench(bbfile, n, tmpd):
+  imgf = os.path.join(tmpd, 'bench.png')
+  thmf = os.path.join(tmpd, 'bench-thumb.png')
+  runs = dict((p, []) for p in PHASES)
+  for i in range(n):
+    j = bbio.load(bbfile) # afresh each time since genStats changes the params
+    t0 = time.time(); bb.genStats(j['params'], j['data'])
+    t1 = time.time(); bb.genGraph()
+    t2 = time.time(); bb.genImage(imgf)
+    t3 = time.time(); bb.genThumb(thmf)
+    t4 = time.time()
+    for (p, t) in zip(PHASES, [t1-t0, t2-t1, t3-t2, t4-t3]): runs[p].append(t)
+  return runs
+
+# Summarize a list of timings as median and 95th percentile
+def summ(x): return { 'median': np.median(x), 'p95': np.percentile(x, 95),
+                      'n': len(x) }
+
+# List of (goal, phase, old median, new median) that got slower than thresh
+def regressions(res, base, thresh):
+  out = []
+  for g in sorted(res):
+    if g not in base: continue
+    for p in PHASES:
+      if p not in base[g]: continue
+      old, new = base[g][p]['median'], res[g][p]['median']
+      if new > NOISE and new > old*(1+thresh): out.append((g, p, old, new))
+  return out
+
+def main(argv):
+  try: opts, args = getopt.getopt(argv, "hn:o:b:t:")
+  except getopt.GetoptError: usage()
+  n, outf, basef, thresh = 5, None, None, .2
+  for opt, arg in opts:
+    if   opt == '-h': usage()
+    elif opt == '-n': n = int(arg)
+    elif opt == '-o': outf = arg
+    elif opt == '-b': basef = arg
+    elif opt == '-t': thresh = float(arg)
+  files = bbfiles(args or [DATA])
+  if not files: usage()
+  base = json.load(open(basef))['goals'] if basef else {}
+
+  os.chdir(HERE) # blib wants its images and palette in the current directory
+  tmpd = tempfile.mkdtemp()
+  res = {}
+  try:
+    print('%-24s' % 'goal', ''.join('%18s' % p for p in PHASES), '  (ms)')
+    for f in files:
+      g = os.path.basename(f)
+      res[g] = dict((p, summ(x)) for (p, x) in bench(f, n, tmpd).items())
+      print('%-24s' % g[:24], ''.join('%9.1f /%7.1f' % (res[g][p]['median']*1e3,
+                                                        res[g][p]['p95']*1e3)
+                                      for p in PHASES))
+      sys.stdout.flush()
+  finally: shutil.rmtree(tmpd, ignore_errors=True)
+  tot = dict((p, sum(res[g][p]['median'] for g in res)) for p in PHASES)
+  print('%-24s' % 'TOTAL (medians)',
+        ''.join('%18.1f' % (tot[p]*1e3) for p in PHASES))
+
+  if outf:
+    json.dump({ 'repeats': n, 'when': bb.shdt(time.time()), 'goals': res },
+              open(outf, 'w'), indent=1, sort_keys=True)
+    print('Saved baseline to', outf)
+  if basef:
+    regs = regressions(res, base, thresh)
+    for (g, p, old, new) in regs:
+      print('REGRESSION: %s %s %.1fms -> %.1fms (+%d%%)' %
+            (g, p, old*1e3, new*1e3, round((new/old-1)*100) if old else 0))
+    if regs: exit(1)
+    print('No regressions beyond', str(int(thresh*100))+'%', 'vs', basef)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
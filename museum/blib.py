@@ -38,13 +38,16 @@ import warnings
 import time, datetime, calendar
 import os, re
 import uuid # just used for tempify
+from functools import wraps
 import matplotlib; matplotlib.use('Agg') # stackoverflow.com/questions/4931376
 import matplotlib.pyplot as plt
 import matplotlib.dates as dt
 import matplotlib.image as mpi
+from matplotlib.collections import LineCollection
 import numpy as np
 from scipy.signal import filtfilt, butter
-from scipy.interpolate import interp1d
+import bseries as bs
+import bbio
 #from subprocess import check_output # slurp system call output as string
 
 ################################################################################
@@ -55,6 +58,7 @@ DIY    = 365.25      # this is what physicists use, eg, to define a light year
 SID    = 86400       # seconds in a day (not used: DIM=DIY/12, WIM=DIY/12/7)
 BDUSK  = 2147317201  # ~2038, specifically rails's ENDOFDAYS+1 (was 2^31-2weeks)
 ZFUN   = lambda x: 0 # function that always returns zero
+ZFUNV  = lambda x: np.zeros(len(x)) # same but for an array of timestamps
 IMGMAG = next(p for p in ['/usr/bin/convert', '/usr/local/bin/convert']
               if os.path.exists(p)) # path to ImageMagick convert utility
 
@@ -115,12 +119,21 @@ AGGR = { # Map possible aggday settings to lambdas that aggregate thusly
 }
 
 AKH    = 7*SID  # Akrasia Horizon, in seconds
+PEPOCH = dt.date2num(datetime.datetime(1970,1,1)) # plot time of unixtime 0
 ASP    = .6514  # ASPect ratio; monitors like 2560x1600, 1440x900 are .625 (5/8)
 DPI    = 100.0  # DPI for graph generation; should not have any effect normally
 SCL    = 2.0    # Scale for the initial PNG which is then scaled back
 PRAF   = .015   # Fraction of plot range that the axes extend beyond
 AXW    = .85    # Axes Width (fraction of the plot width that graph takes up)
 AXH    = .88    # Axes Height (fraction of the plot height that graph takes up)
+TIMING = False  # Whether to record timings of the phases of genStats, etc
+MAVG   = 'ema'  # Smoother for the moving average line: 'ema' or 'butterworth'
+LODPX  = .25    # Skip dots hidden to within this many pixels (0: draw them all)
+BBDIR  = os.path.dirname(os.path.abspath(__file__)) # Where to find the images
+ASSETS = { 'jollyroger': 'jollyroger_sqr.png', # Skull and crossbones
+           'infinity':   'infinity.png',       # Infinity symbol
+           'smiley':     'smiley.png',         # Smiley face
+           'bullseye':   'bullseye.png', }     # Bullseye for the goal date
 DYEL   = (1.0,   1.0,   0.4  ) # Dark yellow  (mma 1,1,.55; py 1,1,.4)
 LYEL   = (1.0,   1.0,   0.60 ) # Light yellow (mma 1,1,.68; py 1,1,.6)
 ROSE   = (1.0,   0.5,   0.5  ) # (originally 1,1/3,1/3 then 251,130,199)
@@ -271,8 +284,8 @@ def setglobal(s, x): globals()[s] = x
 
 def initGlobals():
   global data, flad, fuda, allvals, aggval, worstval, rdf,rtf,lnf, nw, dtf, \
-         watermarks, figtitle, auraf,aurup,aurdn, siru, oresets, derails, \
-         hashhash
+         rdfv, lnfv, watermarks, figtitle, auraf,aurup,aurdn, auracof, siru, \
+         oresets, derails, hashhash, aggtv
 
   data    = []    # List of (timestamp,value) pairs, one value per day
   flad    = None  # Flatlined datapoint, if any
@@ -280,16 +293,21 @@ def initGlobals():
   allvals = {}    # Maps timestamp to list of values on that day
   aggval  = {}    # Maps timestamp to single aggregated value on that day
   worstval = {}   # Maps timestamp to min/max (depending on yaw) value that day
+                  # (all three computed only as they're looked up; see procData)
+  aggtv   = bs.columns([]) # aggval as a pair of sorted arrays: times, values
   rdf     = ZFUN  # Pure function mapping timestamp to the y-value of the YBR
   rtf     = ZFUN  # Maps timestamp to YBR rate (derivative of rdf wrt time)
   lnf     = ZFUN  # Maps timestamp to lane width, not counting noisy width
   nw      = 0     # Noisy width; true lane width is this maxed with lnf
+  rdfv    = ZFUNV # Vectorized rdf: array of timestamps to array of YBR values
+  lnfv    = ZFUNV # Vectorized lnf: array of timestamps to array of lane widths
   dtf     = ZFUN  # Maps timestamp to most recent data value
   watermarks = [] # Text objects for watermarks
   figtitle = None # Stats summary across top of graph image; not normally used
   auraf   = ZFUN  # Pure function that fits the data smoothly, for the aura
   aurup   = 0     # Amount to shift up from auraf to make the aura
   aurdn   = 0     # Amount to shift down from auraf to make the aura
+  auracof = None  # Coefficients of the polynomial auraf, once it's been fit
   siru    = None  # Seconds in rate units, eg: runits=="d" => 86400
   scalf   = 1/400 # Scale factor for dot sizes and line thicknesses
   oresets = []    # List of timestamps of odometer resets
@@ -303,6 +321,44 @@ def initGlobals():
 ################################################################################
 ################ GENERAL UTILITIES (not specific to Beeminder) #################
 
+# Opt-in instrumentation. With TIMING set, the phases of genStats and genGraph
+# and a few hot helpers record their wall time and number of calls. The counts
+# for the current goal are in timings, which genStats resets and also returns as
+# the 'timings' out-param; tallies has the same thing summed over every goal.
+# With TIMING unset, timed functions just call straight through.
+timings = {} # Maps name of phase to [seconds, calls] for the current goal
+tallies = {} # Same but summed over all goals, for batch runs
+
+# Charge the time since t0 to the phase called name
+def tick(name, t0):
+  el = time.time() - t0
+  for d in (timings, tallies):
+    x = d.setdefault(name, [0.0, 0])
+    x[0] += el
+    x[1] += 1
+
+# Context manager to time a block of code as the phase called name
+class timer:
+  def __init__(self, name): self.name = name
+  def __enter__(self): self.t0 = time.time()
+  def __exit__(self, *exc):
+    if TIMING: tick(self.name, self.t0)
+
+# Decorator to time every call of a function as a phase named after it
+def timed(f):
+  @wraps(f)
+  def g(*args, **kwargs):
+    if not TIMING: return f(*args, **kwargs)
+    t0 = time.time()
+    try:     return f(*args, **kwargs)
+    finally: tick(f.__name__, t0)
+  return g
+
+# Timings (default: the current goal's) as a dict suitable for json
+def timingsOut(d=None):
+  d = timings if d is None else d
+  return dict((k, { 'secs': round(s, 6), 'calls': n }) for k,(s,n) in d.items())
+
 def nummy(x):   return  type(x) is int or \
                         type(x) is float or \
                         type(x) is np.float64 or \
@@ -682,6 +738,9 @@ def hashextract(s): return set(re.findall(r'(?:^|\s)(#[a-zA-Z]\w+)(?=$|\s)', s))
 def plottm(u): return dt.date2num(datetime.datetime.utcfromtimestamp(u))
 def unixtm(p): return calendar.timegm(dt.num2date(p).timetuple())
 
+# Vectorized plottm: convert an array of unix times to an array of plot times
+def plottmv(u): return np.asarray(u, dtype=float)/SID + PEPOCH
+
 # Good delta: Returns the delta from the given point to the centerline of the 
 # road but with the sign such that being on the good side of the road gives a 
 # positive delta and being on the wrong side gives a negative delta.
@@ -701,6 +760,7 @@ def gdelt(t_v): t,v = t_v; return chop(yaw*(v-rdf(t)))
 #  lanage*yaw ==  1: right lane (blue dot)
 #  lanage*yaw == -1: wrong lane (orange dot)
 #  lanage*yaw <= -2: beemergency or derailed (red dot)
+@timed
 def lanage(t_v, l=None): 
   t,v = t_v
   l = l or (max(nw, lnf(t)) if noisy else lnf(t))
@@ -716,6 +776,28 @@ def lanage(t_v, l=None):
     if yaw < 0 and intp <= 0: return int(intp-1)
   return int(round(sign(x)*ceil(abs(x))))
 
+# Vectorized lanage: takes arrays of timestamps and values and returns the
+# array of lanes, doing exactly the arithmetic lanage does for each point.
+def lanagev(t, v):
+  t = np.asarray(t, dtype=float)
+  v = np.asarray(v, dtype=float)
+  l = np.maximum(nw, lnfv(t)) if noisy else lnfv(t)
+  d = v - rdfv(t)
+  thin = np.abs(l) < 1e-7 # chop(l) == 0
+  x = d / np.where(thin, 1.0, l)
+  fracp, intp = np.modf(x)
+  x = np.where(np.abs(fracp) < 1e-7, intp, x) # ichop
+  fracp, intp = np.modf(x)
+  wrap = fracp > .99999999 # because of modf's floating point strangeness
+  intp = np.where(wrap, intp+1, intp)
+  fracp = np.where(wrap, 0, fracp)
+  out = np.round(np.sign(x)*np.ceil(np.abs(x)))
+  whole = np.abs(fracp) < 1e-7
+  if yaw > 0: out = np.where(whole & (intp >= 0), intp+1, out)
+  if yaw < 0: out = np.where(whole & (intp <= 0), intp-1, out)
+  edge = np.where(np.abs(d) < 1e-7, yaw, np.sign(d)*666)
+  return np.where(thin, edge, out).astype(int)
+
 # Whether the given point is on the road if the road has lane width l
 def aok(p, l):  return (lanage(p, l) * yaw >= -1.0)
 
@@ -762,6 +844,7 @@ def limd(n):
 # 2. If the graph is noisy and you're in the *wrong* lane, then the width is 
 #    fixed so it's just like the straightforward case of non-noisy graphs 
 #    except you have to max lnf(t) with noisyWidth.
+@timed
 def dtd(v):
   t = tcur
   fnw = 0.0 if gdelt((t,v)) >= 0 else nw # future noisy width
@@ -874,6 +957,24 @@ def roadfunc(tini, vini, road, x):
 
 def genRoadFunc(tini,vini, road): return lambda t: roadfunc(tini,vini, road, t)
 
+# Vectorized version of genRoadFunc: the returned function takes an array of
+# timestamps and returns the array of centerline values. Same arithmetic as
+# roadfunc but with a binary search for the segment instead of a linear walk.
+def genRoadFuncV(tini, vini, road):
+  rt = np.array([tini] + [r[0] for r in road], dtype=float)
+  rv = np.array([vini] + [r[1] for r in road], dtype=float)
+  rr = np.array([0.0]  + [r[2]/siru for r in road], dtype=float)
+  if np.any(np.diff(rt) < 0): # only roadfunc's linear walk gets these right
+    f = genRoadFunc(tini, vini, road)
+    return lambda x: np.array([f(i) for i in x], dtype=float)
+  def rdfv0(x):
+    x = np.asarray(x, dtype=float)
+    i = np.searchsorted(rt, x, side='right') # first row with x < its time
+    j = np.clip(i, 1, len(rt)-1)
+    y = rv[j-1] + rr[j]*(x - rt[j-1])
+    return np.where(i == 0, rv[0], np.where(i == len(rt), rv[-1], y))
+  return rdfv0
+
 # Appropriate color for a datapoint
 # (could pass in segment type (gap or not) and use black(?) dots if gap)
 def dotcolor(t_v):
@@ -889,6 +990,26 @@ def dotcolor(t_v):
   if l*yaw <= -2.0:                return REDDOT
   return BLCK
 
+# Dot colors in the order grDots draws them, so later ones end up on top
+DOTCOLS = [BLCK, REDDOT, ORNDOT, BLUDOT, GRNDOT]
+
+# Vectorized dotcolor: classify arrays of timestamps and values in one pass,
+# returning an array of indices into DOTCOLS.
+def dotcolorv(t, v):
+  l = lanagev(t, v)
+  c = np.zeros(len(l), dtype=int) # BLCK
+  if yaw == 0:
+    c[l == -1] = 2
+    c[(l == 0) | (l == 1)] = 3
+    c[np.abs(l) > 1] = 4
+  else:
+    ly = l*yaw
+    c[ly <= -2] = 1
+    c[ly == -1] = 2
+    c[ly ==  1] = 3
+    c[ly >=  2] = 4
+  return c
+
 # Whether we're officially off the road (off both yesterday and today)
 def isLoser(t_v):
   t,v = t_v
@@ -991,6 +1112,30 @@ def genLaneFunc():
                        rtf0(x))
   #                    (rdf(x) if exprd else 1.0)*rtf0(x)  #SCHDEL
 
+# Vectorized version of genLaneFunc, mapping an array of timestamps to the array
+# of lane widths. Needs rdfv to exist already.
+def genLaneFuncV():
+  road0 = deldups(road, lambda x: x[0])
+  t = np.array([x[0] for x in road0], dtype=float)
+  if np.any(np.diff(t) < 0): # stepify gets unsorted times wrong; so do we
+    lnf0 = genLaneFunc()
+    return lambda x: np.array([lnf0(i) for i in x], dtype=float)
+  r = [abs(x[2])*SID/siru for x in road0]
+  r.append(0.0)
+  rb = foldlist(lambda x,y: x if abs(y)<1e-7 else y, r[0], r[1:])    # backwards
+  rr = reversed(r[:])
+  rf = reversed(foldlist(lambda x,y: x if abs(y)<1e-7 else y, r[-1], rr)) # forw
+  r = np.array([argmax(abs, [b,f]) for (b,f) in zip(rb, rf)], dtype=float)
+  rt = [x[0] for x in road]
+  verts = np.array([x for x in rt if rt.count(x) > 1], dtype=float) # vertseg
+  def lnfv0(x):
+    x = np.asarray(x, dtype=float)
+    i = np.searchsorted(t, x, side='right') - 1 # like stepify
+    rtf0 = np.where(i < 0, r[0], r[1:][np.clip(i, 0, len(t)-1)])
+    rd = np.abs(rdfv(x) - rdfv(x-SID))
+    return np.maximum(np.where(np.in1d(x, verts), 0, rd), rtf0)
+  return lnfv0
+
 # Take a filled-in road matrix (and tini/vini), and current datapoint 
 # (tcur,vcur) and a desired safety buffer s. Return retroratcheted road matrix.
 #def retroRatchet(tini, vini, road, tcur, vcur, s):
@@ -1030,33 +1175,18 @@ def genLaneFunc():
 ################################################################################
 ################################ TRANSFORM DATA ################################
 
-# Transform list l as follows: every time there's a decrease in value from one
-# element to the next where the second value is zero, say V followed by 0, add V
-# to every element afterwards. (should use a generator/yield instead of append)
-def odomify0(l):
-  if not l: return l
-  curadd = 0
-  prev = l[0]
-  out = [prev]
-  for i in l[1:]:
-    if i == 0: curadd += prev
-    prev = i
-    out.append(i + curadd)
-  return out
-
-# Similar to above but for (t,v) pairs or (t,v,c) triples: every time there's a
-# decrease in value from one datapoint to the next where the second value is
-# zero, say (t1,V) followed by (t2,0), add V to the value of every datapoint on
-# or after t2. This is what you want if you're reporting odometer readings (eg,
+# Transform a list of (t,v) pairs as follows: every time there's a decrease in
+# value from one datapoint to the next where the second value is zero, say
+# (t1,V) followed by (t2,0), add V to the value of every datapoint on or after
+# t2. This is what you want if you're reporting odometer readings (eg,
 # your page number in a book can be thought of that way) and the odometer gets 
 # accidentally reset (or you start a new book but want to track total pages read
 # over a set of books). This should be done before kyoomify and will have no 
 # effect on data that has actually been kyoomified since kyoomification leaves 
 # no nonmonotonicities.
 def odomify(d):
-  tdata = zip(*d) #py3 zip needs to be wrapped in list
-  tdata[1] = odomify0(tdata[1])
-  return zip(*tdata) #py3 wrap zip in list
+  (tv, vv) = bs.columns(d)
+  return zip(tv.tolist(), bs.odomify(vv).tolist()) #py3 wrap zip in list
 
 # Here's a version of the above that does that for *all* decreases, {t1,V} to
 # {t2,v}, adding V to the value of every datapoint on or after t2.
@@ -1073,8 +1203,9 @@ def odomify(d):
 # after asof date, do the aggday'ing and kyooming and odomifying, set outparams
 # like numpts, etc
 # Returns a string indicating errors, or the empty string if none.
+@timed
 def procData():
-  global data,fuda, aggday, aggval,allvals,worstval, asof, tini,vini, \
+  global data,fuda, aggday, aggval,allvals,worstval, aggtv, asof, tini,vini, \
     road, numpts, tdat, mean, meandelt, oresets, derails, hashhash
 
   # It's kinda dumb how many separate full walks thru the data we take here
@@ -1109,25 +1240,31 @@ def procData():
   if vini is None:
     if yoog=='meta/users':   vini = 451
 
-  aggval.clear(); allvals.clear()
-  grouped = splitby(data, lambda x: x[0]) # put datapts with same t in sublists
-  pre = 0 # initialize cumulative total so far as we walk thru
-
-  for group in grouped:          # each group is a day
-    t = group[0][0]              # timestamp for this day
-    vl = [v for (t,v) in group]  # list of values for the datapoints on this day
-    ad = AGGR[aggday](vl)        # agg'd datapoint value for this day
-    if kyoom:
-      if aggday=='sum': allvals[t] = [i+pre for i in accumulate(vl)]
-      else:             allvals[t] = [i+pre for i in vl]
-      aggval[t] = pre + ad
-      pre += ad                  # (Eg if yesterday's aggval was 10 and today's
-    else:                        # values are 1, 2, 1 then for kyoomy & aggday
-      allvals[t] = vl            # sum we get allvals 10+1, 10+3, 10+4)
-      aggval[t] = ad
-    worstval[t] = (max(allvals[t]) if yaw<0 else min(allvals[t]))
-
-  data = [(t,aggval[t]) for t in sorted(aggval.keys())]
+  (tv, vv) = bs.columns(data)
+  off = bs.groups(tv)            # each day is the datapoints off[i]:off[i+1]
+  days = tv[off[:-1]]            # timestamp for each day
+  vals = [v for (t,v) in data]
+  ads = [AGGR[aggday](vals[a:b]) # agg'd datapoint value for each day
+         for (a,b) in zip(off[:-1], off[1:])]
+  if kyoom:                      # (Eg if yesterday's aggval was 10 and today's
+    cum = bs.kyoom(ads)          # values are 1, 2, 1 then for kyoomy & aggday
+    pre = np.repeat(np.concatenate([[0], cum[:-1]]), np.diff(off))
+    allv = (bs.kyoomby(vv, off) if aggday=='sum' else vv) + pre
+    ads = cum.tolist()           # sum we get allvals 10+1, 10+3, 10+4)
+    allvals = bs.byday(days, lambda i: allv[off[i]:off[i+1]].tolist())
+  else:
+    allv = vv
+    allvals = bs.byday(days, lambda i: vals[off[i]:off[i+1]])
+  aggval = bs.byday(days, lambda i: ads[i])
+  wv = [] # each day's worst value, once someone asks for one
+  def worst(i, yaw=yaw):
+    if not wv: wv.extend(bs.worst(allv, off, yaw).tolist())
+    return wv[i]
+  worstval = bs.byday(days, worst)
+  days = days.tolist()
+
+  data = zip(days, ads) #py3 wrap zip in list
+  aggtv = (np.array(days), np.array(ads)) # columns of data, even future data
 
   fuda = [x for x in data if x[0] > asof]
   data = [x for x in data if x[0] <= asof]
@@ -1173,6 +1310,7 @@ def showrow(row):
   return str(t)+', '+str(v)+', '+str(r)
 
 # Sanity check the input parameters. Return non-empty string if it fails.
+@timed
 def vetParams():
   def s(y): return str(y) # I'm a bit too obsessed with fitting things in 80 cha
 
@@ -1273,7 +1411,10 @@ def setRange():
     elif vmin >  vmax:  vmin, vmax = vmax, vmin # swap them
     return
   a, b = rdf(tmin), rdf(tmax) # spikes in YBR may still be outside plot range
-  d0 = [v for t,v in data if tmin <= t <= tmax]
+  (tv, vv) = aggtv             # data, sans flatlined point, is aggtv up to asof
+  (i, j) = bs.span(tv, tmin, min(tmax, asof))
+  d0 = vv[i:j].tolist()
+  if flad is not None and tmin <= flad[0] <= tmax: d0.append(flad[1])
   mind = min(d0) if d0 else 0 # min datapoint
   maxd = max(d0) if d0 else 0 # max datapoint
   padding = max(lnw/3, (maxd-mind)*PRAF*2) # scooch a bit beyond min/max datapts
@@ -1320,8 +1461,9 @@ def flatline():
 
 # Where most of the real work happens in computing goal stats.
 # Returns a string indicating errors, or '' if none.
+@timed
 def procParams():
-  global tini,vini, tfin,vfin,rfin, rdf, rtf, lnf, nw, dtf, road, \
+  global tini,vini, tfin,vfin,rfin, rdf, rtf, lnf, nw, dtf, road, rdfv,lnfv, \
     tcur,vcur,rcur, ravg, safebuf, tluz, delta, rah, cntdn, \
     lnw, stdflux, lane, color, loser, tluz, dueby, safebump, sadbrink
 
@@ -1346,11 +1488,14 @@ def procParams():
     return "Road dial error\\n" + parenerr
 
   rdf = genRoadFunc(tini, vini, road)
+  rdfv = genRoadFuncV(tini, vini, road)
 
   rtf = genRateFunc()
   stdflux = noisyWidth([(t,v) for t,v in data if t>=tini])
   nw = autowiden(data, stdflux) if noisy and abslnw is None else 0.0
   lnf = genLaneFunc() if abslnw is None else lambda x: abslnw
+  lnfv = genLaneFuncV() if abslnw is None else \
+         lambda x: np.full(len(x), abslnw, dtype=float)
 
   flatline()
   tcur, vcur = data[-1] # might be the flatlined datapoint
@@ -1402,6 +1547,7 @@ def procParams():
 # Helper function for genStats that's called after the out-params are set for 
 # the graph. It considers all the possible graph types and constructs the 
 # appropriate human-readable summary lines.
+@timed
 def sumSet():
   global statsum, lanesum, ratesum, limsum, deltasum, graphsum, headsum, \
          titlesum, progsum
@@ -1595,6 +1741,7 @@ def dayifyrow(row):
   return (dayify(row[0]),) + row[1:]
 
 # Convert all the daystamps to unixtimes; return converted data
+@timed
 def stampIn(p, d):
   if 'asof'     in p: p['asof']     = dayparse(p['asof'])
   if 'tini'     in p: p['tini']     = dayparse(p['tini'])
@@ -1606,6 +1753,13 @@ def stampIn(p, d):
   # Stable-sort by timestamp before dayparsing the timestamps because if the 
   # timestamps were actually given as unixtime then dayparse works like dayfloor
   # and we lose fidelity.
+  if isinstance(d, bbio.Columns): # as loaded by bbio.load, already unixtimes
+    o = np.argsort(d.t, kind='mergesort')
+    tl = [float(t) if dy else dayfloor(t) for (t, dy) in zip(d.t[o].tolist(),
+                                                      d.tday[o].tolist())]
+    vl = [int(v) if vi else v for (v, vi) in zip(d.v[o].tolist(),
+                                                 d.vint[o].tolist())]
+    return zip(tl, vl, [d.c[i] for i in o]) #py3 wrap zip in list
   return [(dayparse(t), v, c) for (t,v,c) in sorted(d, key = lambda x: x[0])]
 
 # Convert unixtimes back to daystamps
@@ -1627,6 +1781,7 @@ def genStats(p, d, tm=None):
          fullroad, pinkzone, tluz, tcur, tdat, error
 
   tm = tm or time.time() # start the clock immediately
+  timings.clear()
   legacyIn(p)
   initGlobals()
   proctm = tm
@@ -1659,11 +1814,39 @@ def genStats(p, d, tm=None):
   for k in q.keys(): q[k] = eval(k)
   stampOut(q)
   legacyOut(q)
+  if TIMING: q['timings'] = timingsOut()
   return q
 
 ################################################################################
 ############################## GENERATE THE GRAPH ##############################
 
+# Decoded image assets by (name, stride), never written to once loaded
+imgcache = {}
+
+# The image with the given name in ASSETS as a read-only array, or None if the
+# file's missing. It's read from disk and decoded just once per process. If px
+# is given, the width in pixels it'll be drawn at, then a big image is first
+# subsampled down towards that (and that's cached too) so there's less for
+# matplotlib to resample every time.
+def asset(name, px=None):
+  if (name, 1) not in imgcache:
+    f = os.path.join(BBDIR, ASSETS[name])
+    img = mpi.imread(f) if os.path.exists(f) else None
+    if img is not None: img.flags.writeable = False
+    imgcache[(name, 1)] = img
+  img = imgcache[(name, 1)]
+  if img is None or px is None or img.shape[1] < 2*px: return img
+  s = int(img.shape[1]//px) # stride
+  if (name, s) not in imgcache:
+    img = img[::s, ::s].copy()
+    img.flags.writeable = False
+    imgcache[(name, s)] = img
+  return imgcache[(name, s)]
+
+# Load all the image assets, eg, in a long-running process before forking
+def preload():
+  for name in ASSETS: asset(name)
+
 # Return a finely spaced array of numbers from a to b for plotting purposes.
 # 600-6000 is best fidelity but we had it at 200-2000 for a long time.
 def griddle(a, b): return np.linspace(a, b, clip((b-a)//SID+1, 600, 6000))
@@ -1686,6 +1869,7 @@ def fb(xvec, ytop, ybot, **kwargs):
   plt.fill_between(map(plottm, xvec), ytop, ybot, **kwargs)
 
 # Set up axes and tick marks before plotting anything else
+@timed
 def grAxesPre():
   plt.minorticks_on()
   plt.grid(which='major', axis='x', linestyle='-', color='#aaaaaa')
@@ -1719,6 +1903,7 @@ def grAxesPre():
 # Add the plot title and other post-graphing stuff like drawing another frame 
 # to keep the guidelines from being visible on top of axes. This is mostly still
 # magic from Uluc.
+@timed
 def grAxesPost():
   ptmin = plottm(tmin) # retrieve data limits
   ptmax = plottm(tmax)  
@@ -1802,18 +1987,18 @@ def rendrect(s, rect, align='center'):
                          clip_on=False, interpolation='nearest')
 
 # Watermark: safebuf on good side of the YBR and pledge on bad side
+@timed
 def grWatermark():
-  skl = "jollyroger_sqr.png" # image of skull and crossbones (jolly roger)
-  inf = "infinity.png"       # image of infinity symbol
-  sml = "smiley.png"         # image of smiley face
-  if loser and os.path.exists(skl): g = mpi.imread(skl)
-  else:                             g = str(waterbuf)
+  px = SCL*imgsz*AXW/2 # about how wide a quadrant is in the saved image
+  skl = asset('jollyroger', px)
+  if loser and skl is not None: g = skl
+  else:                         g = str(waterbuf)
   b = str(waterbux)
 
-  if   g == 'inf': g = mpi.imread(inf)
-  elif g == ':)':  g = mpi.imread(sml)
-  if   b == 'inf': b = mpi.imread(inf)
-  elif b == ':)':  b = mpi.imread(sml)
+  if   g == 'inf': g = asset('infinity', px)
+  elif g == ':)':  g = asset('smiley',   px)
+  if   b == 'inf': b = asset('infinity', px)
+  elif b == ':)':  b = asset('smiley',   px)
 
   tmid = (tmin+tmax)/2
   vmid = (vmin+vmax)/2
@@ -1831,6 +2016,7 @@ def grWatermark():
   else:                 rendrect(g, tl, 'left');  rendrect(b, br, 'right') #MOAR
 
 # Generate the paved yellow brick road and the dotted centerline
+@timed
 def grRoad():
   # maybe just get the YBR value at all kinks in the road, plus the endpoints...
   #xvec= sorted(deldups([tmin,tmax] + [t for (t,v,r) in road if tmin<=t<=tmax]))
@@ -1876,28 +2062,57 @@ def grAhorizon():
     horizontalalignment='center',
     verticalalignment='center', fontsize=7)
 
-# Show a gray line for odom resets
-def grOdomResets(xvec):
+# Pixels per second along the x-axis, in the final image
+def pxps(): return imgsz*AXW / ((tmax-tmin)*(1+2*PRAF))
+
+# Pixels per unit of the y-axis
+def pxpv(): return imgsz*ASP*AXH / ((vmax-vmin)*(1+2*PRAF))
+
+# The range of times that can show up on the graph: the x-axis limits plus the
+# width of the biggest dot, since a dot just outside the axes can poke into them
+def viewtimes():
+  m = PRAF*(tmax-tmin) + dsz(4)*DPI/72/pxps()
+  return (tmin-m, tmax+m)
+
+# Days with odom resets in the plot range, at most one per pixel column, since
+# any more would just be drawn on top of each other
+def resetdays():
+  pps = pxps()
+  out = []
+  for t in sorted(set(dayfloor(t) for t in oresets if tmin <= t <= tmax)):
+    if not out or int((t-tmin)*pps) != int((out[-1]-tmin)*pps): out.append(t)
+  return out
+
+# Hashtag labels to show, as (day, label) pairs. Labels closer together than
+# the height of a line of text would overlap so each run of those is merged
+# into the first one, without repeating any hashtags. So the number of labels
+# is bounded by the width of the graph, not by how many hashtags there are.
+def hashlabels():
+  gap = 7/72*DPI / pxps() # seconds spanned by the height of a 7pt label
+  out = []
+  for t in sorted(hashhash.keys()):
+    if t > tmax or t < tmin or not hashhash[t]: continue
+    d = dayfloor(t)
+    if out and d - out[-1][0] < gap:
+      out[-1][1].extend(sorted(hashhash[t] - set(out[-1][1])))
+    else: out.append((d, sorted(hashhash[t])))
+  return [(d, ' '.join(tags)) for (d, tags) in out]
+
+# Show a gray line for odom resets, all as one LineCollection
+def grOdomResets():
   va = vmin - PRAF*(vmax-vmin)
   vb = vmax + PRAF*(vmax-vmin)
-  for t in xvec:
-    if t > tmax or t < tmin: continue
-    x = plottm(dayfloor(t))
-    plt.plot_date([x,x], [va,vb], color=BLCK, linewidth=.05*scalf, dashes=(5,5),
-      marker='None')
-    #xt = x + (plottm(tmax)-plottm(tmin))*.021 #SCHDEL
+  xs = plottmv(resetdays())
+  if not len(xs): return
+  plt.gca().add_collection(LineCollection(
+    [[(x,va), (x,vb)] for x in xs], colors=[BLCK], linewidths=.05*scalf,
+    linestyles=[(0, (5,5))]))
 
 # Show the hashtags as labels on the graph
 def grHashtags():
-  va = vmin - PRAF*(vmax-vmin)
-  vb = vmax + PRAF*(vmax-vmin)
-  for t in hashhash.keys():
-    if t > tmax or t < tmin or not hashhash[t]: continue
-    x = plottm(dayfloor(t))
-    #plt.plot_date([x,x], [va,vb], color=BLCK, linewidth=.01*scalf, 
-    #  marker='None')
-    xt = x + (plottm(tmax)-plottm(tmin))*.021
-    plt.text(xt, (vmin+vmax)/2, ' '.join(hashhash[t]),
+  for (t, s) in hashlabels():
+    xt = plottm(t) + (plottm(tmax)-plottm(tmin))*.021
+    plt.text(xt, (vmin+vmax)/2, s,
       rotation=90, color=BLCK,
       horizontalalignment='center',
       verticalalignment='center', fontsize=7)
@@ -1908,10 +2123,12 @@ def grHashtags():
 # Uluc notes that we should use an acausal filter to prevent the lag in 
 # the thin purple line.
 
-# Helper function for Exponential Moving Average; returns smoothed value at x.
-# Very inefficient since we recompute the whole moving average up to x for 
-# every point we want to plot.
-def ema0(data, x):
+# Exponential Moving Average of the data at each of the (sorted) times in xvec.
+# Between datapoints the data is taken to be linear and the EMA of that has a
+# closed form, so it's one pass over the data to get the EMA at each datapoint
+# and then each x is a vectorized lookup of its interval.
+@timed
+def ema(data, xvec):
   # The Hacker's Diet recommends 0.1
   # Uluc had .0864
   # http://forum.beeminder.com/t/control-exp-moving-av/2938/7 suggests 0.25
@@ -1919,64 +2136,70 @@ def ema0(data, x):
   if yoog=='meta/derev':   KEXP = .03/SID  # .015 looks good for meta/derev
   if yoog=='meta/dpledge': KEXP = .03/SID  # .1 was too jagged for meta/dpledge
 
-  (xp, yp) = data[0]  # previous x-value, previous y-value
-  prev = yp
-  if x < xp: return prev
-  for i in data[1:]:  # compute line equation
-    dt = i[0]-xp
-    A = (i[1]-yp)/dt  # (why was this line marked as a to-do?)
-    B = yp
-    if x < i[0]:        # found the interval; compute intermediate point
-      dt = x-xp
-      return B + A*dt - A/KEXP + (prev - B + A/KEXP) * exp(-KEXP*dt)
-    else:               # not the current interval; compute next point
-      prev = B + A*dt - A/KEXP + (prev - B + A/KEXP) * exp(-KEXP*dt)
-      (xp, yp) = i
-  # keep computing the exponential past the last datapoint if needed
-  dt = x-xp
-  return     B + A*dt - A/KEXP + (prev - B + A/KEXP) * exp(-KEXP*dt)
+  xd = np.array([r[0] for r in data], dtype=float)
+  yd = np.array([r[1] for r in data], dtype=float)
+  xvec = np.asarray(xvec, dtype=float)
+  if len(xd) < 2: return np.full(len(xvec), yd[0])
+  dx = np.diff(xd)
+  A = np.zeros(len(dx))       # slope of each line segment between datapoints,
+  A[dx>0] = np.diff(yd)[dx>0]/dx[dx>0] # or 0 if they're on the same day
+  prev = [yd[0]]              # EMA at each datapoint
+  for k in range(len(xd)-1):
+    dt = xd[k+1]-xd[k]
+    B = yd[k]
+    prev.append(B + A[k]*dt - A[k]/KEXP + (prev[k] - B + A[k]/KEXP) \
+                                          * exp(-KEXP*dt))
+  prev = np.array(prev)
+  k = np.searchsorted(xd, xvec, side='right') - 1 # datapoint left of each x
+  i = np.clip(k, 0, None)
+  j = np.clip(k, 0, len(xd)-2) # its segment, or past the end, the last one
+  dt = xvec - xd[i]
+  out = yd[j] + A[j]*dt - A[j]/KEXP + (prev[i] - yd[j] + A[j]/KEXP) \
+                                      * np.exp(-KEXP*dt)
+  out[k < 0] = yd[0] # before the first datapoint it's just the first value
+  return out
+
+# Zero-lag low-pass Butterworth filter of the data, resampled to xvec
+@timed
+def butterworth(data, xvec):
+  # Compute cutoff frequency in terms of the Nyquist rate
+  dayspersample = ( (data[-1][0]-data[0][0])//SID+1)/len(xvec)
+  cutoffdays = 40
+  # Wn = 1 is half the sample frequency.
+  Wn = max(2.0/(cutoffdays/dayspersample), 0.05)
+  (b, a) = butter(8, Wn, btype = 'low') # Design the filter
+  datax = [r[0] for r in data]
+  datay = [r[1] for r in data]
+  newy = np.interp(xvec, datax, datay) # regularly spaced, linearly interpolated
+  return filtfilt(b, a, newy, padtype='constant')
 
 # Function to generate samples for the Butterworth filter
 def griddlefilt(a, b): return np.linspace(a, b, clip((b-a)//SID+1, 40, 2000))
 
-# Exponentially weighted moving average line (purple)
+# The moving average line, as x- and y-vectors, using whichever smoother MAVG
+# says; the other one isn't computed at all.
+def mavg():
+  if MAVG == 'butterworth':
+    xvec = griddlefilt(data[0][0], data[-1][0])
+    return xvec, butterworth(data, xvec)
+  xvec = griddle(data[0][0], data[-1][0])
+  return xvec, ema(data, xvec)
+
+# Moving average line (purple)
+@timed
 def grMovingAv():
   if len(data) == 1 or data[-1][0]-data[0][0] <= 0: return
+  (xvec, yvec) = mavg()
+  pdxy(xvec, yvec, color=PURP, fmt='bo', marker='None', linestyle='-',
+                   linewidth=.6*scalf)
 
-  # Create new vector for filtering datapoints
-  newx = griddlefilt(data[0][0], data[-1][0])
+# Offset added to timestamps for the polynomial fit of the aura
+SMOOTH = (1e5 * SID + 2208974400)
 
-  # Compute cutoff frequency in terms of the Nyquist rate
-  dayspersample = ( (data[-1][0]-data[0][0])//SID+1)/len(newx)
-  cutoffdays = 40
-  # Wn = 1 is half the sample frequency.
-  Wn = max(2.0/(cutoffdays/dayspersample), 0.05)
-  #print(Wn)
-
-  # Design the filter
-  (b, a) = butter(8, Wn, btype = 'low')
-
-  # Restructure data properly
-  (datax, datay) = zip(*data)
-  # Interpolate
-  datafun = interp1d(datax, datay, kind='linear', copy='false')
-  # Compute regularly spaced arrays
-  newy = datafun(newx)
-  # Filter
-  filteredy = filtfilt(b, a, newy, padtype='constant')
-  # Reshape data to the old format
-  newdata = zip(newx, filteredy)
-
-  # Plot the old, exponential filter
-  pd([(x, ema0(data,x)) for x in griddle(data[0][0], data[-1][0])], 
-     color=PURP, fmt='bo', marker='None', linestyle='-', linewidth=.6*scalf)
-  # Plot the new filter response TODO
-  #pd(newdata, 
-  #   color=BLCK, fmt='bo', marker='None', linestyle='-', linewidth=.6*scalf)
-
-# Return a pure function that fits the data smoothly, used by grAura
+# Return the coefficients (highest power first) of a cubic that fits the data
+# smoothly, as a function of t+SMOOTH. Used for the aura; see setAura.
+@timed
 def smooth(data):
-  SMOOTH = (1e5 * SID + 2208974400)
   (x,y) = zip(*data)
   xnew = [i+SMOOTH for i in x]
   warnings.simplefilter('error', np.RankWarning)
@@ -1991,10 +2214,7 @@ def smooth(data):
     c2 = np.polyfit(xnew, y, 2)
     coeff = c2.tolist()
     coeff.insert(0, 0.0)
-  return (lambda x: coeff[3] + \
-                    coeff[2]*(x+SMOOTH) + \
-                    coeff[1]*(x+SMOOTH)**2 + \
-                    coeff[0]*(x+SMOOTH)**3)
+  return np.array(coeff, dtype=float)
 
 # Return a pure function that fits the data smoothly, used by grAura
 # HT Abe Othman and http://en.wikipedia.org/wiki/Tikhonov_regularization
@@ -2058,40 +2278,66 @@ def smooth2(data):
 #    delta = delta*delta
 #  return yest
 
-# Generate guide lines parallel to the centerln on the good side of the YBR
-# and make a thicker one at 7 days safety buffer (or whatever akrasia horiz is).
-def grGuidelines(xvec):
-  def pd0(x, y, c, t=1): 
-    pdxy(x, y, color=c, fmt='bo', marker='None', linestyle='-', 
-               linewidth=t*.4*scalf, clip_box=[.1,.1,.9,.9])
-
-  if len(xvec) < 3: return
-  dt = 1.1*(xvec[2] - xvec[1])
+# Amounts to shift the centerline by for each guiding line, with their colors
+def guideshifts():
   if   lnw>0 and (vmax-vmin) / lnw   <= 32: delta = lnw
   elif lnw>0 and (vmax-vmin)/(6*lnw) <= 32: delta = 6*lnw # was 7
   else:                                     delta = (vmax-vmin)/32
   shift = 0 # amount to shift the centerline by for each guiding line
   i = 0
+  out = []
   while abs(shift) <= vmax-vmin and i < 99: # i<99 check should be superfluous
     shift += yaw*delta
     i += 1
     if abs(shift) == lnw: continue # if first gline is on road edge, skip it
-    rd = [rdf(t) + shift for t in xvec]
-    pd0(xvec, rd, [DYEL, LYEL][int(i%2)], 1)
+    out.append((shift, [DYEL, LYEL][int(i%2)]))
+  return out
 
-    if not aura: continue # below is for aura overlap (NB: call grAura first)
-    tlim = asof+AKH  # max x-value aura extends to; should DRY this up
-    newd = [(t,v) for (t,v) in zip(xvec,rd) if t <= tlim and \
-                                          aurdn < v-auraf(t) < aurup]
-    if not newd: continue
-    chunks = split(newd, lambda x,y: y[0]-x[0] <= dt)
-    for x in chunks: pd0(*(zip(*x)+[GRUE]))
+# Draw the given list of lines (arrays of (x,y) points, in plot time) as one
+# LineCollection, styled like the lines plot_date would draw
+def lc(segs, colors, widths):
+  plt.gca().add_collection(LineCollection(segs, colors=colors,
+    linewidths=widths, capstyle='projecting', joinstyle='round'))
+
+# Generate guide lines parallel to the centerln on the good side of the YBR
+# and make a thicker one at 7 days safety buffer (or whatever akrasia horiz is).
+# The road is evaluated once and all the guidelines are rows of one 2-D array
+# (guidelines x samples), drawn as a single LineCollection. Where they pass
+# through the aura they get drawn over in GRUE, along with the thick line, as
+# a second LineCollection.
+@timed
+def grGuidelines(xvec):
+  if len(xvec) < 3: return
+  xvec = np.asarray(xvec, dtype=float)
+  px = plottmv(xvec)
+  rd = rdfv(xvec)
+  gl = guideshifts()
   # thick guiding line showing the safety buffer cap of 7 days
   bc = (bufcap() if not maxflux else yaw*maxflux)
-  pd0(xvec, [rdf(t) + bc for t in xvec], BIGG, 2.5)
+  big = np.column_stack((px, rd + bc))
+  if not gl: lc([big], [BIGG], [2.5*.4*scalf]); return
+  shifts = np.array([shift for (shift, c) in gl])
+  rds = rd[np.newaxis,:] + shifts[:,np.newaxis] # one row per guideline
+  pxs = np.broadcast_to(px, rds.shape)
+  lc(np.dstack((pxs, rds)), [c for (shift, c) in gl], .4*scalf)
+
+  segs = []
+  if aura and setAura(): # aura overlap
+    tlim = asof+AKH  # max x-value aura extends to; should DRY this up
+    dev = rds - auraf(xvec)
+    ins = (xvec <= tlim) & (aurdn < dev) & (dev < aurup)
+    # runs of consecutive samples inside the aura, as (row, start, end) triples
+    edge = np.diff(np.pad(ins, ((0,0),(1,1)), 'constant').astype(int), axis=1)
+    (r0, c0) = np.nonzero(edge ==  1)
+    (r1, c1) = np.nonzero(edge == -1)
+    segs = [np.column_stack((px[a:b], rds[r, a:b])) for (r, a, b) in
+            zip(r0, c0, c1)]
+  lc(segs + [big], [GRUE]*len(segs) + [BIGG],
+                   [.4*scalf]*len(segs) + [2.5*.4*scalf])
 
 # Used with grAura() and for computing mean and meandelt, this adds dummy 
 # datapoints on every day that doesn't have a datapoint, interpolating linearly.
+@timed
 def gapFill(d):
   start = int(d[0][0])
   end = int(d[-1][0])
@@ -2112,34 +2358,48 @@ def gapFill(d):
 
   return [sandwich(prev[sint(x[0])], x, nxt[sint(x[0])]) for x in d]
 
-# Aura around the points. This (but confusingly not the aura overlap) is drawn
-# below everything else, even the watermark.
-def grAura():
-  global auraf, aurup, aurdn
-  if len(data) == 1 or data[-1][0]-data[0][0] <= 0: return
+# Fit the aura to the data, setting auracof, auraf, aurup, and aurdn. The fit
+# is done once per goal state (genStats resets it) and shared by everything
+# that needs it. Returns whether there's enough data for an aura at all.
+def setAura():
+  global auraf, aurup, aurdn, auracof
+  if auracof is not None: return True
+  if len(data) <= 1 or data[-1][0]-data[0][0] <= 0: return False
   d = [(t,v) for (t,v) in data if t >= tmin]
-  auraf = smooth(gapFill(d))
+  c = smooth(gapFill(d))
+  auracof = c
+  # Takes a timestamp or an array of them
+  auraf = lambda x: np.polyval(c, np.asarray(x, dtype=float) + SMOOTH)
   # original aura was wide enough to cover every point; now using stdflux
   #aurdn = min(-lnw/2.0, min(v-auraf(t) for (t,v) in data))
   #aurup = max( lnw/2.0, max(v-auraf(t) for (t,v) in data))
   aurdn = min(-lnw/2.0, -stdflux)
   aurup = max( lnw/2.0,  stdflux)
+  return True
+
+# Aura around the points. This (but confusingly not the aura overlap) is drawn
+# below everything else, even the watermark.
+@timed
+def grAura():
+  if not setAura(): return
   fudge = PRAF*(tmax-tmin)
   xvec = griddle(tmin-fudge, min(asof+AKH, tmax+fudge))
-  fb(xvec, [auraf(x)+aurdn for x in xvec],
-           [auraf(x)+aurup for x in xvec], edgecolor=BLUE, facecolor=BLUE, 
-                                           zorder=-1, alpha=1.0)
+  a = auraf(xvec)
+  fb(xvec, a+aurdn, a+aurup, edgecolor=BLUE, facecolor=BLUE,
+                             zorder=-1, alpha=1.0)
 
 # Opacity/transparency doesn't look right so draw the intersection explicitly.
 # This is an amalgamation of grRoad() and grAura().
 def grOverlap():
-  if len(data) == 1 or data[-1][0]-data[0][0] <= 0: return
+  if not setAura(): return
   fudge = PRAF*(tmax-tmin)
   xvec = griddle(tmin-fudge, min(asof+AKH, tmax+fudge))
-  aurlo = [max(auraf(x)+aurdn, rdf(x)-lnw) for x in xvec]
-  aurhi = [min(auraf(x)+aurup, rdf(x)+lnw) for x in xvec]
-  aurwh = [l < h for (l,h) in zip(aurlo, aurhi)]
-  fb(xvec, aurlo, aurhi, where=aurwh, edgecolor=GRUE, facecolor=GRUE, alpha=.4)
+  a = auraf(xvec)
+  r = rdfv(xvec)
+  aurlo = np.maximum(a+aurdn, r-lnw)
+  aurhi = np.minimum(a+aurup, r+lnw)
+  fb(xvec, aurlo, aurhi, where=aurlo < aurhi, edgecolor=GRUE, facecolor=GRUE,
+                         alpha=.4)
 
 # Pink Zone, aka Verboten Zone aka No Zone
 def grPinkzone():
@@ -2156,7 +2416,7 @@ def grPinkzone():
 
 def grBullseye(x_y):
   x,y = x_y
-  img = mpi.imread("bullseye.png") # image of bullseye
+  img = asset('bullseye', SCL*30)
   xsize = 30/(imgsz*AXW)*(tmax-tmin)
   ysize = 60/(imgsz*AXW)*(vmax-vmin)
   l = plottm(x - xsize/2);  b = y - ysize/2
@@ -2167,81 +2427,99 @@ def grBullseye(x_y):
   # to zorder=1 but then it's still not always right. we might need to go back
   # to having explicit zorder for everything like uluc did originally
 
-# Plot the purple steppy line, plus a bigger purple dot at each datapoint
-def grSteppy():
+# The purple steppy line (including the flatlined point) and the purple dots
+# (excluding it), as pairs of x- and y-vectors sorted by time
+def steppypts():
   a = tini # maybe more efficient to max w/ the datapoint just left of tmin
   b = min(asof, tmax) # stop the steppy line at asof or tmax, whichever's first
   
-  # First plot the purple steppy line without the dots, including flatlined pt
-  if tini in allvals: dpre = [(tini, max(allvals[tini]) if dir<0 else \
-                                     min(allvals[tini]))]
-  else:               dpre = []
-  d = dpre + [(t,v) for t,v in aggval.iteritems() if a<=t<=b] 
-  #py3 iteritems->items
+  # First the purple steppy line without the dots, including flatlined pt.
+  # Only what's visible, plus a point to the left to step into the view from.
+  (tv, vv) = aggtv
+  (i0, j) = bs.span(tv, a, b)
+  (i, _) = bs.span(tv, max(a, viewtimes()[0]), b, 1)
+  i = max(i, i0)
+  if tini in allvals and i == i0: d = [(tini, max(allvals[tini]) if dir<0 else \
+                                             min(allvals[tini]))]
+  else:                           d = []
   if flad is not None: d += [flad]
-  d.sort()
-  pd(d, color=PURP, fmt='bo', marker='None', linestyle='steps-post-',
-        drawstyle='steps-post', linewidth=.9*scalf)
-  # Now draw the actual purple dots, except the flatlined point
-  a = max(tini, tmin)
-  d = [(t,v) for t,v in aggval.iteritems() if a<=t<=b] #py3 iteritems->items
-  d.sort() # uluc bug fix
-  pd(d, color=PURP, fmt='bo', marker='o',linestyle='None', markeredgewidth=0,
-        drawstyle='steps-post', markersize=2.8*scalf, linewidth=.9*scalf)
-
-# Helper for grDots, dot styles for past data, flatlined point, and future data
+  (pt, pv) = bs.columns(d)
+  (at, av) = (tv[i:j], vv[i:j])
+  (x, y) = (np.concatenate([pt, at]), np.concatenate([pv, av]))
+  o = np.lexsort((y, x)) # sorted by time, then value, like the list of pairs
+  # Now the actual purple dots, except the flatlined point
+  d2 = bs.window(tv, vv, max(tini, tmin), b) # uluc bug fix: sorted
+  return (x[o], y[o]), d2
+
+# Plot the purple steppy line, plus a bigger purple dot at each datapoint
+@timed
+def grSteppy():
+  ((x, y), (x2, y2)) = steppypts()
+  if len(x): pdxy(x, y, color=PURP, fmt='bo', marker='None',
+                  linestyle='steps-post-', drawstyle='steps-post',
+                  linewidth=.9*scalf)
+  if len(x2): pdxy(x2, y2, color=PURP, fmt='bo', marker='o', linestyle='None',
+                   markeredgewidth=0, drawstyle='steps-post',
+                   markersize=2.8*scalf, linewidth=.9*scalf)
+
+# Helper for grDots, dot styles for past data, flatlined point, and future data.
+# These are kwargs for scatter so the sizes are areas, ie, squared markersizes.
 def dottype(t):
-  dot = 'fmt'
-  siz = 'markersize'
-  mew = 'markeredgewidth'
-  mec = 'markeredgecolor'
+  dot = 'marker'
+  siz = 's'
+  mew = 'linewidths'
+  mec = 'edgecolors'
   alf = 'alpha'
   rgb = 'color'
   qs  = .25*scalf # quarter scale factor
   upd = ('v' if yaw>0 else '^') # up or down triangle for derailments
   return {
-    'AGGPAST':   { dot:'o', siz:dsz(2),    mew:qs, mec:BLCK, alf:1.0 },
-    'AGGFUTURE': { dot:'o', siz:dsz(2),    mew:qs, mec:BLCK, alf:.33 },
-    'FLATLINE':  { dot:'>', siz:dsz(2.6),  mew:0,  mec:BLCK, alf:1.0 },
-    'RAWPAST':   { dot:'o', siz:dsz(1.5),  mew:0,  mec:BLCK, alf:1.0 },
-    'RAWFUTURE': { dot:'o', siz:dsz(1.5),  mew:0,  mec:BLCK, alf:.33 },
-    'DERAIL':    { dot:upd, siz:dsz(4),    mew:0, rgb:REDDOT, alf:1 },
-    'HOLLOW':    { dot:'o', siz:dsz(1),    mew:0,  rgb:WITE   },
+    'AGGPAST':   { dot:'o', siz:dsz(2)**2,   mew:qs, mec:BLCK, alf:1.0 },
+    'AGGFUTURE': { dot:'o', siz:dsz(2)**2,   mew:qs, mec:BLCK, alf:.33 },
+    'FLATLINE':  { dot:'>', siz:dsz(2.6)**2, mew:0,  mec:BLCK, alf:1.0 },
+    'RAWPAST':   { dot:'o', siz:dsz(1.5)**2, mew:0,  mec:BLCK, alf:1.0 },
+    'RAWFUTURE': { dot:'o', siz:dsz(1.5)**2, mew:0,  mec:BLCK, alf:.33 },
+    'DERAIL':    { dot:upd, siz:dsz(4)**2,   mew:0, rgb:REDDOT, alf:1 },
+    'HOLLOW':    { dot:'o', siz:dsz(1)**2,   mew:0,  rgb:WITE   },
   }[t]
 
-# Plot the given datapoints (future points transparent, etc) with dottype t
+# Plot the given datapoints (future points transparent, etc) with dottype t.
+# The dots are colored in one vectorized pass and drawn as a single scatter,
+# sorted by color so they stack the same as drawing each color separately.
+# Matplotlib draws collections before lines of the same zorder, so the zorder
+# is bumped to keep the dots on top of the steppy/rosy lines, as they were when
+# they were drawn with plot_date.
+# Opaque dots that a later dot of the same color covers (to within LODPX
+# pixels) are skipped, which for dense plotall graphs is most of them. Red dots
+# are always drawn, and so are transparent ones (future data), which show
+# what's under them. Derailments and the flatlined point are never skipped
+# either, being drawn separately.
+@timed
 def grDots(data, t):
+  if not data: return
   dict = dottype(t)
-  if 'color' in dict: return pd(data, **dict)
-  for i in [BLCK, REDDOT, ORNDOT, BLUDOT, GRNDOT]:
-    pd([x for x in data if dotcolor(x)==i], color=i, **dict)
-
-# Start at the first data point plus sign*delta and walk forward making the next
-# point be equal to the previous point, clipped by the next point plus or minus 
-# delta. Used for the rose-colored dots.
-def inertia0(x, d, sgn):
-  return foldlist(lambda a, b: clip(a, b-d, b+d), x[0]+sgn*d, x[1:])
-def inertia(dat, delt, sgn):  # data, delta, sign (-1 or +1)
-  tdata = zip(*dat) # transpose of data
-  tdata[1] = inertia0(tdata[1], delt, sgn)
-  return zip(*tdata)
-# Same thing but start at the last data point and walk backwards.
-def inertiaRev(dat, dlt, sgn): return reversed(inertia(reversed(dat), dlt, sgn))
+  (tv, vv) = np.array(data, dtype=float).T
+  if 'color' not in dict:
+    ci = dotcolorv(tv, vv)
+    if LODPX and dict['alpha'] == 1:
+      k = bs.thin(tv*pxps(), vv*pxpv(), ci, LODPX, ci==DOTCOLS.index(REDDOT))
+      (tv, vv, ci) = (tv[k], vv[k], ci[k])
+    o = np.argsort(ci, kind='mergesort')
+    tv, vv = tv[o], vv[o]
+    dict['c'] = np.array(DOTCOLS)[ci[o]]
+  plt.scatter(plottmv(tv), vv, zorder=2.5, **dict)
+
+# The rosy progress line, as x- and y-vectors (see bseries.rosy)
+def rosyxy():
+  (xvec, vvec) = bs.columns(data)
+  return xvec, bs.rosy(vvec, max(lnw, stdflux), dir)
 
 # Plot the rosy progress line
+@timed
 def grRosy():
-  delta = max(lnw, stdflux)
-  if dir > 0:
-    lo = inertia(   data, delta, -1)
-    hi = inertiaRev(data, delta, +1)
-  else:
-    lo = inertiaRev(data, delta, -1)
-    hi = inertia(   data, delta, +1)
-  yveclo = [v for (t,v) in lo]
-  yvechi = [v for (t,v) in hi]
-  yvec = [(l+h)/2.0 for (l,h) in zip(yveclo, yvechi)]
-  xvec = [t for (t,v) in data]
-  pdxy(xvec, yvec, fmt='bo', marker='o', color=ROSE,
+  (xvec, yvec) = rosyxy()
+  (i, j) = bs.span(xvec, *viewtimes(), pad=1) # just the part that's visible
+  pdxy(xvec[i:j], yvec[i:j], fmt='bo', marker='o', color=ROSE,
                    linestyle='-', markersize=dsz(2.7), markeredgecolor=ROSE,
                    markeredgewidth=0, linewidth=.8*scalf)
 
@@ -2256,9 +2534,41 @@ def emptyGraph(msg):
                       verticalalignment='center', size=9)
   plt.ylabel(yaxis)
 
+# If the timespan of the graph (tmax - tmin) is at least 73 days then this 
+# scalf is a constant 1/400. If fewer days then this will be up to twice that.
+# This gives the radius of the colored inner disk for datapoints (as a 
+# fraction of the width of the whole graph) and everything else is some amount
+# bigger than that. (Currently the black disk that surrounds the colored one 
+# is 3/2 times as big and the rose or purple dots are (3/2)^2 times as big.)
+def setScalf():
+  global scalf
+  scalf = cvx(tmax, (tmin, tmin+73*SID), (2,1)) / 400 * imgsz
+
+# The datapoints drawn on top of everything else, as (dottype, points) pairs in
+# the order they're drawn. Used by genGraph and the SVG backend alike. Only the
+# days that can show up on the graph, found by binary search of aggtv. Within
+# each set the dots are in the order they stack in (see bseries.stacking).
+def dotsets():
+  (tv, vv) = aggtv
+  (i, j) = bs.span(tv, *viewtimes())
+  k = min(max(np.searchsorted(tv, asof, 'right'), i), j) # first day past asof
+  past = zip(tv[i:k].tolist(), vv[i:k].tolist()) #py3 wrap zip in list
+  futr = zip(tv[k:j].tolist(), vv[k:j].tolist()) #py3 wrap zip in list
+  out = []
+  if plotall:  # note that allvals and aggval don't include flatlined datapoint
+    out.append(('RAWPAST',   [(t,v) for (t,_) in past for v in allvals[t]]))
+    out.append(('RAWFUTURE', [(t,v) for (t,_) in futr for v in allvals[t]]))
+  out.append(('AGGPAST', past))
+  out.append(('HOLLOW', [(t,v) for (t,v) in past if v not in allvals[t]]))
+  out.append(('AGGFUTURE', futr))
+  if flad is not None: out.append(('FLATLINE', [flad]))
+  return [(typ, [pts[i] for i in bs.stacking([t for (t,_) in pts])])
+          for (typ, pts) in out]
+
 # Call genStats to set global data, params before calling this.
+@timed
 def genGraph():
-  global asof, tini,tfin,tmax, figtitle, road, tcur, tdat, tluz, scalf
+  global asof, tini,tfin,tmax, figtitle, road, tcur, tdat, tluz
 
   #plt.xkcd() # tee hee
   plt.close('all')
@@ -2275,13 +2585,7 @@ def genGraph():
       "(We've pinged Beeminder support to come help fix things up here!)"+
       "\n\n"+error); return
 
-  # If the timespan of the graph (tmax - tmin) is at least 73 days then this 
-  # scalf is a constant 1/400. If fewer days then this will be up to twice that.
-  # This gives the radius of the colored inner disk for datapoints (as a 
-  # fraction of the width of the whole graph) and everything else is some amount
-  # bigger than that. (Currently the black disk that surrounds the colored one 
-  # is 3/2 times as big and the rose or purple dots are (3/2)^2 times as big.)
-  scalf = cvx(tmax, (tmin, tmin+73*SID), (2,1)) / 400 * imgsz
+  setScalf()
 
   grAxesPre()
   if aura: grAura()
@@ -2289,7 +2593,7 @@ def genGraph():
   grRoad() # also calls grGuidelines
   grAhorizon()
   grDots([(t, worstval[t+SID]) for t in derails], 'DERAIL')
-  grOdomResets(oresets)
+  grOdomResets()
   if hashtags: grHashtags()
   if aura: grOverlap()
   grPinkzone()
@@ -2298,29 +2602,20 @@ def genGraph():
   if steppy:   grSteppy()
   if rosy:     grRosy()
 
-  if plotall:  # note that allvals and aggval don't include flatlined datapoint
-    plotme = flatten([[(t,v) for v in vl] for t,vl in allvals.iteritems()]) 
-    #py3 iteritems->items
-    grDots([(t,v) for (t,v) in plotme if t <= asof], 'RAWPAST')
-    grDots([(t,v) for (t,v) in plotme if t >  asof], 'RAWFUTURE')
-  grDots([(t,v) for t,v in aggval.iteritems() if t <= asof], 'AGGPAST') 
-  #py3 iteritems->items x2
-  tmp = [(t,v) for t,v in aggval.iteritems() if t<=asof and v not in allvals[t]]
-  grDots(tmp, 'HOLLOW')
-  grDots([(t,v) for t,v in aggval.iteritems() if t > asof], 'AGGFUTURE') 
-  #py3 iteritems->items
-  if flad is not None: grDots([flad], 'FLATLINE')
+  for (t, d) in dotsets(): grDots(d, t)
   grAxesPost()
 
 # Having created a plot with genGraph above, export it to the given filename, f.
+@timed
 def genImage(f):
   # Resize watermark text during drawing
   cid = plt.gcf().canvas.mpl_connect('draw_event', ondraw)
-  plt.savefig(f, dpi=SCL*DPI)
+  with timer('savefig'): plt.savefig(f, dpi=SCL*DPI)
   remap  = " -remap palette.png -colors 256 +dither "
   resize = " -filter Box -resize "+str(100//SCL)+"% "
-  if SCL != 1.0: os.system(IMGMAG+resize+remap+f+" "+f)
-  else:          os.system(IMGMAG+       remap+f+" "+f)
+  with timer('imagemagick'):
+    if SCL != 1.0: os.system(IMGMAG+resize+remap+f+" "+f)
+    else:          os.system(IMGMAG+       remap+f+" "+f)
 
   plt.gcf().canvas.mpl_disconnect(cid)
 
@@ -2331,14 +2626,15 @@ def cstring(r_g_b):
                   sint(round(g*255)) + "," + \
                   sint(round(b*255)) + ")"
 
+@timed
 def genThumb(tf):
   global figtitle
   if figtitle is not None: figtitle.set_visible(False)
   plt.gca().set_position([-0.01, -0.01, 1.02, 1.02])
-  plt.savefig(tf, dpi=.3*DPI)
+  with timer('savefig'): plt.savefig(tf, dpi=.3*DPI)
   remap = " -remap palette.png -colors 256 +dither "
   bord = " -bordercolor '"+cstring(dotcolor((tcur,vcur)))+"' "+"-border 2x2 "
-  os.system(IMGMAG+bord+remap+tf+" "+tf)
+  with timer('imagemagick'): os.system(IMGMAG+bord+remap+tf+" "+tf)
 
 
 ################################################################################
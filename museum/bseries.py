@@ -0,0 +1,155 @@
+"""
+Derived series for Beebrain graphs: the things computed from the datapoints
+rather than entered -- the rosy line's inertia, the steppy line, each day's
+worst value, odometer resets and cumulative (kyoom) totals -- as numpy kernels
+on columns of times and values. They don't touch blib's goal state so blib's
+matplotlib code and the SVG backend (bsvg.py) can share them.
+
+Usage:
+> (tv, vv) = columns(data)        # list of (t,v) pairs to a pair of arrays
+> off = groups(tv)                # where each day's run of datapoints starts
+> worst(vv, off, yaw)             # worst value of each day
+> rosy(vv, delta, dir)            # y-values of the rosy line
+> stepspost(*window(tv, vv, a, b))  # vertices of the steppy line from a to b
+> (i, j) = span(tv, a, b, 1)      # slice of what's visible from a to b, plus
+>                                 #   a point either side for continuity
+> byday(tv[off[:-1]], lambda i: vv[off[i]:off[i+1]])[t]  # day t's values
+> o = stacking(tv)                # order to draw overlapping dots in
+
+Values keep the dtype they come in with (ints stay ints) so that totals of
+integer data print the same as they always have in the stats.
+"""
+
+from __future__ import division #py3
+import numpy as np
+
+# A list of (t,v) pairs (or longer tuples) as an array of times and an array of
+# values
+def columns(pts):
+  if len(pts) == 0: return (np.zeros(0), np.zeros(0))
+  return (np.array([p[0] for p in pts]), np.array([p[1] for p in pts]))
+
+# Offsets of the runs of equal (sorted) times in tv, ie, where each day starts,
+# with len(tv) at the end, so day i is tv[off[i]:off[i+1]]
+def groups(tv):
+  if len(tv) == 0: return np.zeros(1, dtype=int)
+  return np.concatenate([[0], np.flatnonzero(np.diff(tv)) + 1, [len(tv)]])
+
+# The worst value in each group: the min if yaw>0, else the max
+def worst(vv, off, yaw):
+  if len(vv) == 0: return vv
+  return (np.maximum if yaw < 0 else np.minimum).reduceat(vv, off[:-1])
+
+# Every time there's a decrease in value from one element to the next where the
+# second value is zero, say V followed by 0, add V to every element afterwards
+# (see blib.odomify)
+def odomify(vv):
+  vv = np.asarray(vv)
+  if len(vv) == 0: return vv
+  add = np.zeros_like(vv)
+  add[1:] = np.where(vv[1:] == 0, vv[:-1], 0)
+  return vv + np.cumsum(add)
+
+# Cumulative totals: x[0], x[0]+x[1], ...
+def kyoom(x): return np.cumsum(x)
+
+# Cumulative totals restarting at each group, eg the kyoomy values of each of
+# the datapoints on each day when aggday is sum. Done group by group, but only
+# for days with more than one datapoint, to add things up in the same order as
+# summing each day's list would.
+def kyoomby(vv, off):
+  out = np.array(vv)
+  for (a, b) in zip(off[:-1], off[1:]):
+    if b-a > 1: out[a:b] = np.cumsum(vv[a:b])
+  return out
+
+# Start at the first value plus sgn*d and walk forward making each next value be
+# equal to the previous one, clipped to within d of the next datapoint. Used for
+# the rose-colored dots. It's inherently sequential, hence the plain loop.
+def inertia(vv, d, sgn):
+  d = abs(d)
+  vv = np.asarray(vv, dtype=float).tolist()
+  if not vv: return np.zeros(0)
+  x = vv[0] + sgn*d
+  out = [x]
+  for v in vv[1:]:
+    x = min(max(x, v-d), v+d)
+    out.append(x)
+  return np.array(out)
+
+# Same thing but start at the last value and walk backwards
+def inertiarev(vv, d, sgn): return inertia(np.asarray(vv)[::-1], d, sgn)[::-1]
+
+# The y-values of the rosy line for datapoints with values vv: the average of
+# the walks up and down, each hemmed in to within delta of the datapoints,
+# starting from the end that makes it optimistic
+def rosy(vv, delta, dir):
+  if dir > 0: (lo, hi) = (inertia(vv, delta, -1), inertiarev(vv, delta, +1))
+  else:       (lo, hi) = (inertiarev(vv, delta, -1), inertia(vv, delta, +1))
+  return (lo+hi)/2.0
+
+# Indices (i,j) such that tv[i:j] are the times with a <= t <= b, given times
+# tv sorted ascending, plus pad more on either side, for lines that continue
+# into the window from outside it. Binary search, so it takes time proportional
+# to the log of the whole history, not to its length.
+def span(tv, a, b, pad=0):
+  (i, j) = (np.searchsorted(tv, a, 'left'), np.searchsorted(tv, b, 'right'))
+  return (max(i-pad, 0), min(j+pad, len(tv)))
+
+# The datapoints with a <= t <= b (plus pad on either side; see span)
+def window(tv, vv, a, b, pad=0):
+  (i, j) = span(tv, a, b, pad)
+  return (tv[i:j], vv[i:j])
+
+# A read-only dict from the time of each day to something about that day, like
+# the list of its values, computed from the columns only when it's looked up.
+# days are the sorted times of the days, tv[off[:-1]], and f(i) gives the thing
+# for the ith day. Looking a day up is a binary search.
+class byday:
+  def __init__(self, days, f):
+    self.days = days
+    self.f = f
+  def index(self, t):
+    i = np.searchsorted(self.days, t)
+    return i if i < len(self.days) and self.days[i] == t else None
+  def __len__(self): return len(self.days)
+  def __contains__(self, t): return self.index(t) is not None
+  def __getitem__(self, t):
+    i = self.index(t)
+    if i is None: raise KeyError(t)
+    return self.f(i)
+
+# Vertices of the steps-post path through the points (x,y): each point's value
+# is held horizontally till the next point's time and then jumps vertically
+def stepspost(xv, yv):
+  if len(xv) == 0: return (np.zeros(0), np.zeros(0))
+  return (np.repeat(xv, 2)[1:], np.repeat(yv, 2)[:-1])
+
+# The order to draw dots at times tv in (a permutation of their indices) so that
+# where they overlap they don't all stack the same way. In time order each dot
+# would hide most of the face of the one before, leaving a dense run of dots a
+# band of black rims. Instead the days are shuffled by a multiplicative hash
+# (Knuth's, with the golden ratio), which is what Python 2's dict order used to
+# do for us by accident, but deterministic, and the same for a given day however
+# the goal grows or whatever part of it is visible. Dots on the same day stay in
+# the order they came in.
+def stacking(tv):
+  day = np.floor(np.asarray(tv, dtype=float) / 86400).astype(np.int64)
+  return np.argsort(day * 2654435761 % 2**32, kind='mergesort')
+
+# Which of a set of dots, drawn in order and alike except for their colors ci,
+# are worth drawing, as a boolean mask: of the dots with the same color in the
+# same res-by-res cell of a grid (xp and yp are in pixels), only the last one
+# drawn, the one on top, is kept, since it hides the rest to within res pixels.
+# Dots with keep set are kept regardless.
+def thin(xp, yp, ci, res, keep=None):
+  n = len(ci)
+  out = np.zeros(n, dtype=bool) if keep is None else np.array(keep, dtype=bool)
+  if n == 0: return out
+  (cx, cy) = (np.floor(xp/res), np.floor(yp/res))
+  o = np.lexsort((np.arange(n), cy, cx, ci)) # each cell's dots, in draw order
+  last = np.ones(n, dtype=bool)              # last of its cell?
+  last[:-1] = (ci[o][1:]!=ci[o][:-1]) | (cx[o][1:]!=cx[o][:-1]) | \
+              (cy[o][1:]!=cy[o][:-1])
+  out[o[last]] = True
+  return out
@@ -0,0 +1,409 @@
+"""
+SVG backend for Beebrain graphs: writes the graph straight to SVG markup from
+blib's goal state, without going through matplotlib at all.
+
+Usage:
+> stats = blib.genStats(params, data)
+> genSVG(target_svg_filename)   # or a file-like object; NB: genStats first
+
+Draws the same things as blib.genGraph, in the same order: aura, watermarks,
+yellow brick road with its guidelines and dotted centerline, akrasia horizon,
+derailments, odometer resets, hashtags, aura overlap, pink zone, bullseye,
+moving average, steppy and rosy lines, the datapoints, and finally the axes.
+The road is piecewise linear so it's emitted as a polygon through its kinks
+rather than sampled on a grid. All numbers are printed with fixed precision and
+there are no ids or timestamps that vary from run to run, so the same goal
+state always gives byte-identical output (handy for caching and diffing).
+"""
+
+from __future__ import division #py3
+from __future__ import print_function #py3
+import os, base64, datetime
+from math import floor, log10
+from xml.sax.saxutils import escape
+import numpy as np
+import blib as bb
+import bseries as bs
+
+PTPX = bb.DPI/72   # pixels per point; matplotlib sizes are all in points
+FONT = 'DejaVu Sans, Helvetica, Arial, sans-serif'
+
+# Show number: fixed precision, no negative zero, no trailing zeros
+def sn(x):
+  s = '%.2f' % x
+  s = s.rstrip('0').rstrip('.')
+  return '0' if s == '-0' else s
+
+# Convert a matplotlib-style color tuple to something like '#ff8000'
+def hexc(c): return '#%02x%02x%02x' % tuple(int(round(x*255)) for x in c[:3])
+
+uris = {} # Data URIs of image assets by name
+
+# Base64 data URI of one of blib's image assets, so the svg is self-contained.
+# Like blib.asset, each file is only read once per process.
+def pnguri(name):
+  if name not in uris:
+    f = open(os.path.join(bb.BBDIR, bb.ASSETS[name]), 'rb')
+    try:     uris[name] = 'data:image/png;base64,'+base64.b64encode(f.read())
+    finally: f.close()
+  return uris[name]
+
+class Canvas:
+  """Accumulates svg elements, mapping goal coordinates (unixtime, value) to
+  pixels in the plot area of an imgsz by ASP*imgsz image."""
+
+  def __init__(self, ta, tb, va, vb):
+    self.W = bb.imgsz
+    self.H = bb.ASP*bb.imgsz
+    self.pw = bb.AXW*self.W  # plot area width and height
+    self.ph = bb.AXH*self.H
+    self.l = (self.W - self.pw)/2 # plot area left and top
+    self.t = (self.H - self.ph)/2
+    (self.ta, self.tb, self.va, self.vb) = (ta, tb, va, vb)
+    self.out = []
+
+  def x(self, t): return self.l + (t-self.ta)/(self.tb-self.ta)*self.pw
+  def y(self, v): return self.t + (self.vb-v)/(self.vb-self.va)*self.ph
+
+  def pts(self, xvec, yvec):
+    return ' '.join(sn(self.x(t))+','+sn(self.y(v)) for (t,v) in zip(xvec,yvec))
+
+  def add(self, s): self.out.append(s)
+
+  def line(self, xvec, yvec, c, w, dash=None, a=1):
+    if len(xvec) < 2: return
+    self.add('<polyline points="%s" fill="none" stroke="%s" stroke-width="%s"'
+             % (self.pts(xvec, yvec), hexc(c), sn(w*PTPX))
+             + ('' if dash is None else ' stroke-dasharray="%s,%s"'
+                % (sn(dash[0]*w*PTPX), sn(dash[1]*w*PTPX)))
+             + ('' if a == 1 else ' stroke-opacity="%s"' % sn(a)) + '/>')
+
+  # Filled region between ylo and yhi over xvec
+  def band(self, xvec, ylo, yhi, c, a=1, edge=None):
+    if len(xvec) < 2: return
+    self.add('<polygon points="%s %s" fill="%s"'
+             % (self.pts(xvec, ylo), self.pts(xvec[::-1], yhi[::-1]), hexc(c))
+             + ('' if a == 1 else ' fill-opacity="%s"' % sn(a))
+             + ('' if edge is None else ' stroke="%s" stroke-width="%s"'
+                % (hexc(edge), sn(PTPX)) + ('' if a == 1 else
+                                             ' stroke-opacity="%s"' % sn(a)))
+             + '/>')
+
+  # Vertical dashed line all the way across the plot area at time t
+  def vline(self, t, c, w):
+    x = sn(self.x(t))
+    self.add('<line x1="%s" y1="%s" x2="%s" y2="%s" stroke="%s" '
+             'stroke-width="%s" stroke-dasharray="%s"/>'
+             % (x, sn(self.t), x, sn(self.t+self.ph), hexc(c), sn(w*PTPX),
+                sn(5*w*PTPX)))
+
+  def text(self, x, y, s, size, c=bb.BLCK, anchor='middle', rot=0, extra=''):
+    s = escape(s)
+    self.add('<text x="%s" y="%s" font-size="%s" fill="%s" text-anchor="%s" '
+             'dominant-baseline="central"%s%s>%s</text>'
+             % (sn(x), sn(y), sn(size), hexc(c), anchor, extra, '' if rot == 0
+                else ' transform="rotate(%s %s %s)"' % (sn(rot), sn(x), sn(y)),
+                s))
+
+  def image(self, uri, l, r, b, t):
+    self.add('<image x="%s" y="%s" width="%s" height="%s" '
+             'preserveAspectRatio="none" xlink:href="%s"/>'
+             % (sn(self.x(l)), sn(self.y(t)), sn(self.x(r)-self.x(l)),
+                sn(self.y(b)-self.y(t)), uri))
+
+  # A dot of radius r (in pixels) with marker m: 'o' or a triangle '>' 'v' '^'
+  def dot(self, t, v, m, r, fill, edge=None, ew=0, a=1):
+    (x, y) = (self.x(t), self.y(v))
+    sty = ' fill="%s"' % hexc(fill)
+    if edge is not None and ew > 0:
+      sty += ' stroke="%s" stroke-width="%s"' % (hexc(edge), sn(ew*PTPX))
+    if a != 1: sty += ' opacity="%s"' % sn(a)
+    if m == 'o':
+      self.add('<circle cx="%s" cy="%s" r="%s"%s/>' % (sn(x), sn(y), sn(r),sty))
+      return
+    tri = {'>': [(1,0), (-.5,-.866), (-.5,.866)],
+           'v': [(0,1), (-.866,-.5), (.866,-.5)],
+           '^': [(0,-1), (-.866,.5), (.866,.5)]}[m]
+    self.add('<polygon points="%s"%s/>' % (' '.join(sn(x+r*dx)+','+sn(y+r*dy)
+                                                     for (dx,dy) in tri), sty))
+
+  def svg(self, clipped):
+    W, H = sn(self.W), sn(self.H)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+      '<svg xmlns="http://www.w3.org/2000/svg" '
+      'xmlns:xlink="http://www.w3.org/1999/xlink" width="%s" height="%s" '
+      'viewBox="0 0 %s %s" font-family="%s">\n' % (W, H, W, H, FONT) +
+      '<defs><clipPath id="plot"><rect x="%s" y="%s" width="%s" height="%s"/>'
+      '</clipPath></defs>\n' % (sn(self.l), sn(self.t), sn(self.pw),
+                                sn(self.ph)) +
+      '<rect width="%s" height="%s" fill="#ffffff"/>\n' % (W, H) +
+      '<g clip-path="url(#plot)">\n' + '\n'.join(clipped) + '\n</g>\n' +
+      '\n'.join(self.out) + '\n</svg>\n')
+
+################################################################################
+
+# The aura: a smooth fit to the data, as (function, lower offset, upper offset),
+# or None if there's no aura to draw. Shares blib's fit, see blib.setAura.
+def aura():
+  if not bb.aura or not bb.setAura(): return None
+  return (bb.auraf, bb.aurdn, bb.aurup)
+
+# Times from a to b (inclusive) plus every kink in the road in between, which
+# is all it takes to draw anything that's a function of the road exactly
+def kinks(a, b):
+  return [a] + sorted(set(r[0] for r in bb.road if a < r[0] < b)) + [b]
+
+# Pick round-number y-axis ticks, about 6 of them
+def yticks(va, vb):
+  if vb <= va: return []
+  step = (vb - va)/6
+  e = 10**floor(log10(step))
+  step = next(m*e for m in [1, 2, 2.5, 5, 10] if m*e >= step)
+  return [i*step for i in range(int(np.ceil(va/step)), int(floor(vb/step))+1)]
+
+# X-axis ticks as (unixtime, label, major?) triples, spaced like grAxesPre does
+def xticks(ta, tb):
+  utc = datetime.datetime.utcfromtimestamp
+  epoch = datetime.datetime(1970, 1, 1)
+  secs = lambda d: (d - epoch).total_seconds()
+  d = (bb.tmax - bb.tmin) / bb.SID
+  out = []
+  if d < 90: # weekly (or fortnightly) major ticks, daily (or 2-day) minor ones
+    n = 1 if d < 45 else 2
+    day = utc(ta).replace(hour=0, minute=0, second=0, microsecond=0)
+    wk = day - datetime.timedelta(days=(day.weekday()-1) % 7) # tuesdays, as
+    while secs(day) <= tb:                                    # matplotlib does
+      if secs(day) >= ta:
+        major = (day - wk).days % (7*n) == 0
+        out.append((secs(day), day.strftime('%b %d') if major else '', major))
+      day += datetime.timedelta(days=n)
+    return out
+  if   d < 365//2: n = 1
+  elif d < 365:    n = 2
+  elif d < 2*365:  n = 3
+  elif d < 4*365:  n = 6
+  else:            n = 12*int(np.ceil(d/365/8))
+  (y, m) = (utc(ta).year, utc(ta).month)
+  while True:
+    day = datetime.datetime(y, m, 1)
+    if secs(day) > tb: return out
+    if secs(day) >= ta and (m-1) % n == 0:
+      out.append((secs(day), day.strftime('%b' if d < 365 or m != 1 else '%Y'),
+                  True))
+    (y, m) = (y + m//12, m%12 + 1)
+
+# Frame, tick marks, labels and y-axis label. Returns the gridlines separately
+# since they go under everything else.
+def axes(cv, xt, yt, ylab, hide=False):
+  (l, t, r, b) = (cv.l, cv.t, cv.l+cv.pw, cv.t+cv.ph)
+  fs = 8*PTPX
+  grid, ticks = [], []
+  for (tm, s, major) in xt:
+    x = sn(cv.x(tm))
+    k = 3.5 if major else 2
+    if major: grid.append('M%s %sV%s' % (x, sn(t), sn(b)))
+    ticks.append('M%s %sv%sM%s %sv%s' % (x, sn(b), sn(-k), x, sn(t), sn(k)))
+    if s:
+      cv.text(cv.x(tm), b+fs, s, fs)
+      cv.text(cv.x(tm), t-fs, s, fs)
+  for v in yt:
+    y = sn(cv.y(v))
+    ticks.append('M%s %sh3.5M%s %sh-3.5' % (sn(l), y, sn(r), y))
+    if hide: continue
+    cv.text(l-4, cv.y(v), bb.shn(v), fs, anchor='end')
+    cv.text(r+4, cv.y(v), bb.shn(v), fs, anchor='start')
+  cv.add('<path d="%s" stroke="#000000" stroke-width="%s"/>'
+         % (''.join(ticks), sn(.8*PTPX)))
+  cv.add('<rect x="%s" y="%s" width="%s" height="%s" fill="none" '
+         'stroke="#000000" stroke-width="%s"/>'
+         % (sn(l), sn(t), sn(cv.pw), sn(cv.ph), sn(.8*PTPX)))
+  if ylab: cv.text(l/3, (t+b)/2, ylab, fs, rot=-90)
+  if not grid: return ''
+  return '<path d="%s" stroke="#aaaaaa" stroke-width="%s"/>' \
+         % (''.join(grid), sn(.8*PTPX))
+
+# An empty graph with a big message instead of, y'know, a graph.
+def emptySVG(msg):
+  cv = Canvas(-1.03, 1.03, -1.03, 1.03)
+  lines = msg.replace('\\n', '\n').split('\n')
+  for (i, s) in enumerate(lines):
+    cv.text(cv.x(0), cv.y(0) + (i - (len(lines)-1)/2)*11*PTPX, s, 9*PTPX)
+  ticks = [-1, -.5, 0, .5, 1]
+  axes(cv, [(x, '%g' % x, False) for x in ticks], ticks, bb.yaxis)
+  return cv.svg([])
+
+# Watermarks: safebuf on the good side of the YBR and pledge on the bad side
+def watermarks(cv):
+  skl = bb.loser and bb.asset('jollyroger') is not None
+  g = 'JOLLYROGER' if skl else str(bb.waterbuf)
+  b = str(bb.waterbux)
+  imgs = {'JOLLYROGER': 'jollyroger', 'inf': 'infinity', ':)': 'smiley'}
+  (tmin, tmax, vmin, vmax) = (bb.tmin, bb.tmax, bb.vmin, bb.vmax)
+  tmid = (tmin+tmax)/2
+  vmid = (vmin+vmax)/2
+  toff = (tmax-tmin)/25      # offset from quadrant edges
+  voff = (vmax-vmin)/25
+  bl = ((tmin+toff, vmin+voff), (tmid-toff, vmid-voff)) # bottom left
+  br = ((tmid+toff, vmin+voff), (tmax-toff, vmid-voff)) # bottom right
+  tl = ((tmin+toff, vmid+voff), (tmid-toff, vmax-voff)) # top left
+  tr = ((tmid+toff, vmid+voff), (tmax-toff, vmax-voff)) # top right
+
+  def rendrect(s, rect, align):
+    (l,b), (r,t) = rect
+    if s in imgs:
+      mid = (l+r)/2
+      cv.image(pnguri(imgs[s]), mid - (mid-l)*bb.ASP*1.1,
+                                mid + (r-mid)*bb.ASP*1.1, b, t)
+      return
+    (x0, x1, y0, y1) = (cv.x(l), cv.x(r), cv.y(t), cv.y(b))
+    # heavy sans-serif digits are roughly .65em wide
+    fs = min(bb.SCL*(x1-x0)/2.4/(.65*max(len(s), 1)), .9*(y1-y0))
+    x = {'left': x0, 'right': x1}.get(align, (x0+x1)/2)
+    cv.text(x, (y0+y1)/2, s, fs, bb.GRAY,
+            {'left': 'start', 'right': 'end'}.get(align, 'middle'),
+            extra=' font-weight="900"')
+
+  if   bb.dir>0 and bb.yaw<0: rendrect(g, br, 'right'); rendrect(b, tl, 'left')
+  elif bb.dir<0 and bb.yaw>0: rendrect(g, tr, 'right'); rendrect(b, bl, 'left')
+  elif bb.dir<0 and bb.yaw<0: rendrect(g, bl, 'left');  rendrect(b, tr, 'right')
+  else:                       rendrect(g, tl, 'left');  rendrect(b, br, 'right')
+
+# Road, guidelines (with the bits in the aura tinted), and dotted centerline
+def road(cv, ta, tb, au):
+  rdf = bb.rdf
+  lnw, scalf = bb.lnw, bb.scalf
+  xvec = kinks(max(bb.tini, ta), tb)
+  yvec = [rdf(t) for t in xvec]
+  if lnw != 0:
+    cv.band(xvec, [v-lnw for v in yvec], [v+lnw for v in yvec], bb.DYEL, .5,
+            bb.DYEL)
+  else: cv.line(xvec, yvec, bb.DYEL, 2.4*scalf)
+  if bb.yaw != 0:
+    gl = bb.guideshifts()
+    for (shift, c) in gl: cv.line(xvec, [v+shift for v in yvec], c, .4*scalf)
+    if au is not None:
+      cv.add('<g clip-path="url(#aura)">')
+      for (shift, c) in gl:
+        cv.line(xvec, [v+shift for v in yvec], bb.GRUE, .4*scalf)
+      cv.add('</g>')
+    bc = bb.bufcap() if not bb.maxflux else bb.yaw*bb.maxflux
+    cv.line(xvec, [v+bc for v in yvec], bb.BIGG, 2.5*.4*scalf)
+  cv.line(xvec, yvec, bb.ORNG, 1.0*scalf, (20, 40))
+
+# Vertical lines and labels: akrasia horizon, odometer resets, hashtags
+def verticals(cv):
+  (tmin, tmax, scalf) = (bb.tmin, bb.tmax, bb.scalf)
+  xoff = .021*cv.pw/(1+2*bb.PRAF) # same offset grAhorizon uses, in pixels
+  ymid = cv.y((bb.vmin+bb.vmax)/2)
+  t = bb.asof + bb.AKH
+  if tmin <= t <= tmax:
+    cv.vline(bb.dayfloor(t), bb.AKRA, .5*scalf)
+    cv.text(cv.x(bb.dayfloor(t))+xoff, ymid, "Akrasia Horizon", 7*PTPX,
+            bb.AKRA, rot=-90)
+  return xoff, ymid
+
+# Write the graph as svg to f, a filename or a file-like object
+def genSVG(f):
+  s = svgstr()
+  if not isinstance(f, basestring): f.write(s); return #py3 basestring->str
+  fh = open(f, 'w')
+  try:     fh.write(s)
+  finally: fh.close()
+
+# The whole graph as a string of svg
+def svgstr():
+  if bb.yoog == "NOGRAPH":
+    return emptySVG("Beebrain was called with 'NOGRAPH_*' as the slug\n"+
+                    "so no graph or thumbnail was generated, just this\n"+
+                    "static placeholder!")
+  if not bb.data: return emptySVG("No data yet")
+  if bb.error != "":
+    return emptySVG("The following errors prevented us from generating "+
+      bb.yoog+".\n(We've pinged Beeminder support to come help fix things "+
+      "up here!)\n\n"+bb.error)
+
+  bb.setScalf()
+  (tmin, tmax, vmin, vmax) = (bb.tmin, bb.tmax, bb.vmin, bb.vmax)
+  (rdf, lnw, scalf, asof) = (bb.rdf, bb.lnw, bb.scalf, bb.asof)
+  ta = tmin - bb.PRAF*(tmax-tmin) # axis limits, as in grAxesPost
+  tb = tmax + bb.PRAF*(tmax-tmin)
+  va = vmin - bb.PRAF*(vmax-vmin)
+  vb = vmax + bb.PRAF*(vmax-vmin)
+  cv = Canvas(ta, tb, va, vb)
+
+  au = aura()
+  if au is not None:
+    (auraf, aurdn, aurup) = au
+    xvec = bb.griddle(ta, min(asof+bb.AKH, tb))
+    alo = auraf(xvec)+aurdn
+    ahi = auraf(xvec)+aurup
+    cv.band(xvec, alo, ahi, bb.BLUE, 1, bb.BLUE)
+    cv.out.insert(0, '<clipPath id="aura"><polygon points="%s %s"/></clipPath>'
+                     % (cv.pts(xvec, alo), cv.pts(xvec[::-1], ahi[::-1])))
+  watermarks(cv)
+  road(cv, ta, tb, au)
+  (xoff, ymid) = verticals(cv)
+  drawdots(cv, [('DERAIL', [(t, bb.worstval[t+bb.SID]) for t in bb.derails])])
+  for t in bb.resetdays(): cv.vline(t, bb.BLCK, .05*scalf)
+  if bb.hashtags:
+    for (t, s) in bb.hashlabels(): cv.text(cv.x(t)+xoff, ymid, s, 7*PTPX,
+                                           rot=-90)
+
+  if au is not None: # aura overlap: where the aura and the road intersect
+    xvec = bb.griddle(ta, min(asof+bb.AKH, tb))
+    lo = np.maximum(alo, bb.rdfv(xvec)-lnw)
+    hi = np.minimum(ahi, bb.rdfv(xvec)+lnw)
+    chunks = bb.split([p for p in zip(xvec, lo, hi) if p[1] < p[2]],
+                      lambda x,y: y[0]-x[0] <= 1.1*(xvec[1]-xvec[0]))
+    for c in chunks:
+      (x, l, h) = zip(*c)
+      cv.band(x, l, h, bb.GRUE, .4, bb.GRUE)
+
+  xvec = kinks(asof, asof+bb.AKH) # pink zone
+  if bb.yaw < 0: cv.band(xvec, [rdf(x) for x in xvec], [vb]*len(xvec), bb.PINK,
+                         .25, bb.PNKE)
+  else:          cv.band(xvec, [va]*len(xvec), [rdf(x) for x in xvec], bb.PINK,
+                         .25, bb.PNKE)
+  if bb.tfin <= tmax:
+    xs = 30/(bb.imgsz*bb.AXW)*(tmax-tmin)
+    ys = 60/(bb.imgsz*bb.AXW)*(vmax-vmin)
+    (x, y) = (bb.tfin, rdf(bb.tfin))
+    cv.image(pnguri('bullseye'), x-xs/2, x+xs/2, y-ys/2, y+ys/2)
+  if bb.movingav and len(bb.data) > 1 and bb.data[-1][0] > bb.data[0][0]:
+    (xvec, yvec) = bb.mavg()
+    cv.line(xvec, yvec, bb.PURP, .6*scalf)
+  if bb.steppy:
+    (d, d2) = bb.steppypts()
+    if len(d[0]): # steps-post: horizontal then vertical
+      (xs, ys) = bs.stepspost(*d)
+      cv.line(xs, ys, bb.PURP, .9*scalf)
+    for (t,v) in zip(*d2): cv.dot(t, v, 'o', 1.4*scalf*PTPX, bb.PURP)
+  if bb.rosy:
+    (xvec, yvec) = bb.rosyxy()
+    cv.line(xvec, yvec, bb.ROSE, .8*scalf)
+    for (t,v) in zip(xvec, yvec): cv.dot(t, v, 'o', bb.dsz(2.7)/2*PTPX,bb.ROSE)
+  drawdots(cv, bb.dotsets())
+
+  clipped = cv.out
+  cv.out = []
+  clipped.insert(0, axes(cv, xticks(ta, tb), yticks(va, vb), bb.yaxis,
+                         bb.hidey))
+  if bb.stathead: cv.text(cv.W/2, .02*cv.H, bb.graphsum, 7*PTPX)
+  return cv.svg(clipped)
+
+# Draw dots from a list of (dottype, points) pairs, colored like grDots
+def drawdots(cv, sets):
+  for (typ, pts) in sets:
+    if not pts: continue
+    sty = bb.dottype(typ)
+    r = np.sqrt(sty['s'])/2*PTPX
+    (tv, vv) = np.array(pts, dtype=float).T
+    if 'color' in sty: cols = [sty['color']]*len(tv)
+    else:
+      ci = bb.dotcolorv(tv, vv)
+      o = np.argsort(ci, kind='mergesort')
+      (tv, vv) = (tv[o], vv[o])
+      cols = [bb.DOTCOLS[i] for i in ci[o]]
+    for (t, v, c) in zip(tv, vv, cols):
+      cv.dot(t, v, sty['marker'], r, c, sty.get('edgecolors'),
+             sty.get('linewidths', 0), sty.get('alpha', 1))
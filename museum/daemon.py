@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# Beebrain Daemon, the successor to daemon.pl and daemonguts.pl. Watches a
+# directory (by default "nonce") for .bb files appearing or changing and brains
+# them, writing the .json and the images next to them, same as beebrain.py.
+#
+# Instead of polling the directory every second it gets told of changes by the
+# OS (inotify, via the watchdog library). A burst of changes to the same goal
+# (or to its log or snapshot; see bbio.py) is coalesced into one braining, done
+# once the goal has been quiet for SETTLE seconds. And instead of starting a new
+# Python per goal, which costs more than braining most goals does, goals are
+# handed to a pool of N worker processes (-j N) that each import blib once. (The
+# workers have to be processes, not threads, since blib keeps the goal in
+# globals.) A goal that changes while it's being brained gets brained again
+# afterwards; a goal is never brained by two workers at once. Each braining is
+# abandoned after TIMEOUT seconds, like daemonguts's ulimit did. A worker that
+# dies outright (OOM-killed, say) never reports back, so a goal still being
+# brained GRACE seconds after that is given up on as failed too.
+#
+# When lots of goals change at once (a deploy, the morning rush) the ones that
+# matter most get brained first. Each goal gets a due time when it changes: the
+# time it changed plus some slack, and the goal that's due soonest goes next.
+# The slack is DAYSLACK seconds per day of safety buffer the goal had as of its
+# last braining (judging by tluz, or failing that safebuf, or failing that its
+# color, in its .json; new goals count as having none), up to MAXDAYS days, plus
+# BATCHSLACK more if the change was part of a batch. A change counts as a batch
+# one if more than BURST other goals changed within a second of it, or if only
+# the rescan noticed it. So a goal in the red that a user just added data to
+# goes before a comfortable goal that a deploy touched. The slack is capped, so
+# a goal waits at most that long behind goals that changed after it did, and
+# nothing starves however busy it gets.
+#
+# In case the OS drops any events, the whole directory is also rescanned every
+# RESCAN seconds for goals that changed without us hearing about it.
+#
+# The TATS (brainings, failures, average time braining, average and max latency
+# from a goal changing to its output being written, queue length) get printed
+# (overall and for goals that were in the red, with less than a day of buffer)
+# every TATSEVERY seconds that anything happened, and with -m FILE they're kept
+# up to date in FILE as JSON for anything that wants to monitor the daemon.
+#
+# Usage: ./daemon.py [-j N] [-s] [-c DIR] [-m FILE] [DIR]
+# with -s and -c DIR as for beebrain.py.
+
+from __future__ import print_function #py3
+from __future__ import division #py3
+import sys, os, re, time, calendar, json, glob, getopt, signal, threading
+import traceback
+import numbers, collections
+import multiprocessing as mp
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+PATH      = "nonce"
+SETTLE    = .05 # brain a goal once it hasn't changed for this many seconds
+TIMEOUT   = 180 # give up braining a goal after this many seconds
+GRACE     = 30  # and on its worker this many seconds after that
+RESCAN    = 60  # look for changes we missed this often (seconds)
+TATSEVERY = 10  # print the stats this often (seconds), if anything happened
+RECYCLE   = 100 # replace each worker after it's brained this many goals
+DAYSLACK  = 2   # a goal can wait this many seconds per day of safety buffer
+MAXDAYS   = 7   # more safety buffer than this many days makes no difference
+BATCHSLACK = 30 # a goal changed in a batch can wait this much longer (seconds)
+BURST     = 10  # more goals than this changing in a second makes it a batch
+SID       = 86400 # seconds in a day
+COLORDAYS = {'red': 0, 'orange': 1, 'blue': 2, 'green': 3} # buffer per color
+
+def usage():
+  print('USAGE:', sys.argv[0], '[-j N] [-s] [-c DIR] [-m FILE] [DIR]')
+  print('  -j N: brain up to N goals at once (default one per CPU)')
+  print('  -s:   also write an svg version of each graph')
+  print('  -c DIR: reuse output for unchanged goals from the cache in DIR')
+  print('  -m FILE: keep the TATS up to date in FILE as JSON')
+  print('  DIR:  the directory to watch (default '+PATH+')')
+  exit(1)
+
+# Turn a filename like dir/user+graph+stuff.bb into "user/graph" (yoog)
+def yoogify(f):
+  s = os.path.basename(f)
+  if '+' not in s: return f
+  return '/'.join(re.sub(r'\.bb$', '', s).split('+')[:2])
+
+# The goal (.bb file) that a file is an input of, or None if it's not one
+def goalof(f):
+  (base, ext) = os.path.splitext(f)
+  if ext == '.bb': return f
+  if ext in ['.bbl', '.bbs'] and os.path.exists(base+'.bb'): return base+'.bb'
+  return None
+
+# Last time any of a goal's inputs changed, or None if it's gone
+def mtime(bbfile):
+  base = os.path.splitext(bbfile)[0]
+  try:    m = os.path.getmtime(bbfile)
+  except OSError: return None
+  for f in [base+'.bbl', base+'.bbs']:
+    try:    m = max(m, os.path.getmtime(f))
+    except OSError: pass
+  return m
+
+# Days of safety buffer a goal had left as of now, going by its .json from the
+# last time it was brained, or 0 if we don't know, like for a new goal
+def buffer(bbfile):
+  try:
+    with open(os.path.splitext(bbfile)[0] + '.json') as f: s = json.load(f)
+  except (IOError, ValueError): return 0
+  if not isinstance(s, dict): return 0
+  if s.get('loser'): return MAXDAYS # already derailed so no hurry
+  (tluz, safebuf) = (s.get('tluz'), s.get('safebuf'))
+  if isinstance(tluz, basestring) and re.match(r'^\d{8}$', tluz): #py3 str
+    tluz = calendar.timegm(time.strptime(tluz, '%Y%m%d')) # a UTC daystamp
+  if isinstance(tluz, numbers.Number): return (tluz - time.time()) / SID
+  if isinstance(safebuf, numbers.Number): return safebuf
+  return COLORDAYS.get(s.get('color'), 0)
+
+# Worker processes ############################################################
+
+class Timeout(Exception): pass
+
+def alarm(signum, frame): raise Timeout()
+
+opts = {} # beebrain.brain's options, for the workers
+
+def initworker(svg, cdir):
+  global beebrain
+  import beebrain # and thereby blib, matplotlib, etc, just the once
+  opts.update(svg=svg, cdir=cdir)
+  signal.signal(signal.SIGALRM, alarm)
+  signal.signal(signal.SIGINT, signal.SIG_IGN) # ^C is for the parent
+
+# Brain a goal. Returns (bbfile, error message or None, seconds braining).
+def work(bbfile):
+  start = time.time()
+  err = None
+  signal.alarm(TIMEOUT)
+  try:
+    render = beebrain.brain(bbfile, start, opts['svg'], opts['cdir'])
+    if render is None: err = 'beebrain failed'
+    else: render(True) # say which goal, what with other workers talking too
+  except Timeout: err = 'timed out after %ds' % TIMEOUT
+  except Exception: err = traceback.format_exc()
+  finally: signal.alarm(0)
+  sys.stdout.flush()
+  return (bbfile, err, time.time() - start)
+
+# The daemon proper ###########################################################
+
+class Daemon:
+  def __init__(self, path, nproc, svg, cdir, mfile):
+    self.path = path
+    self.nproc = nproc
+    self.mfile = mfile
+    self.cond = threading.Condition()
+    self.pending = {}  # goals waiting: (first, last change, due, red?, batch?)
+    self.busy = {}     # goals being brained: (when changed, red?, since, n)
+    self.n = 0         # how many goals we've handed to the pool
+    self.recent = collections.deque() # (when, goal) for goals that just changed
+    self.known = {}    # each goal's mtime as of when it was last brained
+    self.tats = {'brainings': 0, 'failures': 0, 'rawtime': 0, 'lattime': 0,
+                 'maxlat': 0, 'red': 0, 'redlat': 0, 'redmax': 0, 'queued': 0,
+                 'busy': 0, 'files': 0}
+    self.dirty = False # whether anything happened since the last TATS
+    for f in glob.glob(os.path.join(path, '*.bb')): self.known[f] = mtime(f)
+    self.pool = mp.Pool(nproc, initworker, (svg, cdir), RECYCLE)
+
+  # Note that a goal changed (called from the watchdog thread, among others),
+  # as part of a batch if batch
+  def touch(self, bbfile, batch=False):
+    now = time.time()
+    days = None if bbfile in self.pending else buffer(bbfile)
+    with self.cond:
+      if bbfile in self.pending:
+        (first, _, due, red, bat) = self.pending[bbfile]
+        self.pending[bbfile] = (first, now, due, red, bat)
+        return
+      while self.recent and self.recent[0][0] < now - 1: self.recent.popleft()
+      self.recent.append((now, bbfile))
+      if days is None: days = 0 # it got brained between our looking and now
+      due = now + DAYSLACK * min(max(days, 0), MAXDAYS)
+      self.pending[bbfile] = (now, now, due, days < 1, False)
+      if batch: self.batch(bbfile)
+      if len(self.recent) == BURST + 2: # it's a batch, so the last second was
+        for (_, f) in self.recent: self.batch(f)
+      elif len(self.recent) > BURST + 2: self.batch(bbfile)
+      self.cond.notify()
+
+  # Treat a pending goal's change as part of a batch (with the lock held)
+  def batch(self, bbfile):
+    p = self.pending.get(bbfile)
+    if p is None or p[4]: return
+    self.pending[bbfile] = (p[0], p[1], p[2] + BATCHSLACK, p[3], True)
+
+  def gone(self, bbfile):
+    with self.cond:
+      if bbfile in self.known: print("\nFILE WENT MISSING:", bbfile)
+      self.pending.pop(bbfile, None)
+      self.known.pop(bbfile, None)
+
+  # Goals done changing and not already being brained, in the order to brain
+  # them in: soonest due first
+  def ready(self, now):
+    return sorted((f for (f, p) in self.pending.items()
+                   if now - p[1] >= SETTLE and f not in self.busy),
+                  key=lambda f: self.pending[f][2])
+
+  # Hand a goal to the pool (with the lock held)
+  def dispatch(self, bbfile):
+    (first, _, _, red, _) = self.pending.pop(bbfile)
+    print("\n" + ("CHG" if bbfile in self.known else "NEW") + ":", bbfile,
+          "(" + yoogify(bbfile) + ")")
+    self.known[bbfile] = mtime(bbfile)
+    self.n += 1
+    self.busy[bbfile] = (first, red, time.time(), self.n)
+    self.pool.apply_async(work, (bbfile,),
+                          callback=lambda res, n=self.n: self.done(res, n))
+
+  # Called (in the pool's result thread) when a worker finishes a goal, the nth
+  # one handed to the pool
+  def done(self, result, n):
+    (bbfile, err, dt) = result
+    now = time.time()
+    with self.cond:
+      b = self.busy.get(bbfile)
+      if b is None or b[3] != n: return # given up on by sweep, so already told
+      (first, red, _, _) = self.busy.pop(bbfile)
+      lat = now - first
+      t = self.tats
+      t['brainings'] += 1
+      t['rawtime'] += dt
+      t['lattime'] += lat
+      t['maxlat'] = max(t['maxlat'], lat)
+      if red:
+        t['red'] += 1
+        t['redlat'] += lat
+        t['redmax'] = max(t['redmax'], lat)
+      if err: t['failures'] += 1; print("\nFAILED:", bbfile, err)
+      self.dirty = True
+      self.cond.notify()
+
+  # Give up on goals whose workers died on them (with the lock held)
+  def sweep(self, now):
+    for (f, b) in list(self.busy.items()):
+      if now - b[2] < TIMEOUT + GRACE: continue
+      del self.busy[f]
+      self.tats['brainings'] += 1
+      self.tats['failures'] += 1
+      print("\nFAILED:", f, "worker lost after %ds" % (now - b[2]))
+      self.dirty = True
+
+  # Look for goals that changed without our being told
+  def rescan(self):
+    fs = glob.glob(os.path.join(self.path, '*.bb'))
+    with self.cond:
+      missed = [f for f in fs if f not in self.pending and f not in self.busy
+                and mtime(f) != self.known.get(f)]
+    for f in missed: self.touch(f, batch=True)
+
+  def showtats(self):
+    t = self.tats
+    t['queued'] = len(self.pending)
+    t['busy'] = len(self.busy)
+    t['files'] = len(self.known)
+    b = t['brainings'] or 1
+    r = t['red'] or 1
+    print("\nTATS: %i brainings (%i failed) @ %.3fs raw, %.3fs latency "
+          "(max %.3fs), %.3fs in the red (%i, max %.3fs); %i queued, %i busy "
+          "(%i files)" % (t['brainings'], t['failures'], t['rawtime']/b,
+          t['lattime']/b, t['maxlat'], t['redlat']/r, t['red'], t['redmax'],
+          t['queued'], t['busy'], t['files']))
+    sys.stdout.flush()
+    if self.mfile:
+      tmp = self.mfile + '.tmp'
+      with open(tmp, 'w') as f: json.dump(dict(t, time=time.time()), f)
+      os.rename(tmp, self.mfile)
+
+  def run(self):
+    print("The Beebrain daemon is watching", os.path.join(self.path, '*.bb'),
+          "with", self.nproc, "workers ...")
+    lastscan = lasttats = time.time()
+    self.rescan()
+    self.showtats()
+    while True:
+      now = time.time()
+      if now - lastscan >= RESCAN: self.rescan(); lastscan = now
+      with self.cond:
+        self.sweep(now)
+        if now - lasttats >= TATSEVERY and self.dirty:
+          self.showtats(); self.dirty = False; lasttats = now
+        for f in self.ready(now)[:self.nproc - len(self.busy)]:
+          self.dispatch(f)
+        # Sleep till a goal might be done settling, or something happens
+        wake = [p[1] + SETTLE for p in self.pending.values()]
+        wake = min(wake + [lasttats + TATSEVERY, lastscan + RESCAN])
+        if len(self.busy) >= self.nproc: wake = lastscan + RESCAN
+        # or till a worker that's still busy might've died
+        wake = min([wake] + [b[2]+TIMEOUT+GRACE for b in self.busy.values()])
+        self.cond.wait(max(wake - time.time(), .001))
+
+class Handler(FileSystemEventHandler):
+  def __init__(self, daemon):
+    FileSystemEventHandler.__init__(self)
+    self.daemon = daemon
+  def on_any_event(self, event):
+    if event.is_directory: return
+    for f in [event.src_path, getattr(event, 'dest_path', None)]:
+      g = f and goalof(f)
+      if g is None: continue
+      if os.path.exists(g): self.daemon.touch(g)
+      else:                 self.daemon.gone(g)
+
+def main(argv):
+  try: opts, args = getopt.getopt(argv, "hj:sc:m:")
+  except getopt.GetoptError: usage()
+  nproc = mp.cpu_count()
+  svg = False
+  cdir = None
+  mfile = None
+  for opt, arg in opts:
+    if   opt == '-h': usage()
+    elif opt == '-j': nproc = max(1, int(arg))
+    elif opt == '-s': svg = True
+    elif opt == '-c': cdir = arg
+    elif opt == '-m': mfile = arg
+  if len(args) > 1: usage()
+  path = args[0] if args else PATH
+
+  os.umask(0) # same as beebrain.py
+  d = Daemon(path, nproc, svg, cdir, mfile)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # clean up
+  observer = Observer()
+  observer.schedule(Handler(d), path)
+  observer.start()
+  try: d.run()
+  except KeyboardInterrupt: pass
+  finally:
+    observer.stop()
+    observer.join()
+    sys.stdout.flush()
+    # Not d.pool.terminate(), which hangs (in python 2) if the workers died
+    # first of the same SIGTERM, as when the whole process group gets it. The
+    # workers quit by themselves when they see we're gone, after any goal in
+    # progress.
+    os._exit(0)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
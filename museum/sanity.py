@@ -174,6 +174,7 @@ def serialize(fn, proctm):
   out+= [pf,"dtf(tfin):",sh3(bb.dtf(qo['tfin'])),  '\n']
   out+= [pf,"dtf(tmax):",sh3(bb.dtf(bb.tmax)),     '\n']
 
+  bb.setAura() # the aura is otherwise only fit when graphing
   out+= [pf,"aur(tmin):",sh3(bb.auraf(bb.tmin)),     '\n']
   out+= [pf,"aur(tini):",sh3(bb.auraf(qo['tini'])),  '\n']
   out+= [pf,"aur(tind):",sh3(bb.auraf(bb.tini)),    '\n']